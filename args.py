@@ -42,6 +42,30 @@ def parse_args() -> argparse.Namespace:
         help="Checkpoint of previously trained model to start from (used for pretraining on a different dataset)",
         metavar="FILE",
     )
+    parser.add_argument(
+        "--resume",
+        default=None,
+        help="Training state of an interrupted run (checkpoints/training-state.pth) to continue \
+                        from. The training continues exactly as the interrupted run would have \
+                        (except with --persistent-workers or --cache-val-in-memory), the results \
+                        are written to a new run directory",
+        metavar="FILE",
+    )
+    parser.add_argument(
+        "--checkpoint-interval",
+        default=1,
+        type=int,
+        help="Save the full training state (model, optimizer, epoch, metrics, random number \
+                        generators) every n epochs and after the last epoch, 0 disables it",
+    )
+    parser.add_argument(
+        "--pending-checkpoints",
+        default=2,
+        type=int,
+        help="Maximum number of checkpoints that are written in the background while the \
+                        training continues (each one holds a copy of the weights in memory), \
+                        0 saves them synchronously",
+    )
     parser.add_argument(
         "--imagenet-pretrained",
         default=False,
@@ -73,6 +97,21 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument(
         "--batch-size", default=16, type=int, help="mini-batch size (default: 256)"
     )
+    parser.add_argument(
+        "--accumulation-steps",
+        default=1,
+        type=int,
+        help="Number of batches whose gradients are accumulated for one optimizer step, \
+                        i.e. the effective batch size is batch-size * accumulation-steps",
+    )
+    parser.add_argument(
+        "--micro-batch-size",
+        default=None,
+        type=int,
+        help="Split every batch into micro-batches of this size for the forward and \
+                        backward passes to reduce the memory usage (same gradients, except \
+                        for batchnorm statistics)",
+    )
     parser.add_argument(
         "--cuda-device-ids",
         nargs="+",
@@ -80,6 +119,35 @@ def parse_args() -> argparse.Namespace:
         default=[0],
         help="Cuda device ids. E.g. [0,1,2]. Use -1 for all GPUs available and -2 for cpu only.",
     )
+    parser.add_argument(
+        "--distributed",
+        default=False,
+        action="store_true",
+        help="Distributed data parallel training, one process per device or cpu node. Launch \
+                        with torchrun, e.g. torchrun --nproc_per_node 4 main.py --distributed \
+                        ... With cuda, every process uses the GPU of its local rank. \
+                        --batch-size is the batch size per process",
+    )
+    parser.add_argument(
+        "--dist-backend",
+        default="gloo",
+        choices=["gloo", "nccl"],
+        help="Backend for the distributed training (nccl only for cuda)",
+    )
+    parser.add_argument(
+        "--amp",
+        default="none",
+        choices=["none", "bf16", "fp16"],
+        help="Mixed precision: run the network and the loss under autocast with bfloat16 \
+                        (cpu and cuda) or float16 (cuda only, with gradient scaling)",
+    )
+    parser.add_argument(
+        "--amp-check-images",
+        type=int,
+        default=64,
+        help="Number of validation images on which the mixed precision validation loss is \
+                        compared to float32 after each epoch",
+    )
     parser.add_argument(
         "--output-stride", type=int, default=64, help="Output stride after the encoder"
     )
@@ -90,6 +158,15 @@ def parse_args() -> argparse.Namespace:
         default=[1, 1, 1, 1],
         help="Atrous rates used in the encoder's resblocks",
     )
+    parser.add_argument(
+        "--grad-checkpoint-resblocks",
+        nargs="+",
+        type=int,
+        choices=[2, 3, 4, 5],
+        default=None,
+        help="Resnet encoder resblocks (2 to 5 for conv2 to conv5) whose activations are \
+                        recomputed in the backward pass instead of stored, e.g. 4 5",
+    )
     parser.add_argument(
         "--atrous-rates",
         nargs="+",
@@ -100,6 +177,13 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument(
         "--do-augmentation", default=True, help="do augmentation of images or not"
     )
+    parser.add_argument(
+        "--batch-augmentation",
+        default=False,
+        action="store_true",
+        help="Flip and augment the training images batch-wise on the training device \
+                        instead of per sample in the dataloader workers",
+    )
     parser.add_argument(
         "--augment-parameters",
         default=[0.8, 1.2, 0.5, 2.0, 0.8, 1.2],
@@ -115,6 +199,25 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument(
         "--num-workers", default=4, type=int, help="Number of workers in dataloader"
     )
+    parser.add_argument(
+        "--persistent-workers",
+        default=False,
+        action="store_true",
+        help="Keep the dataloader workers alive across epochs and validation passes",
+    )
+    parser.add_argument(
+        "--prefetch-factor",
+        default=2,
+        type=int,
+        help="Number of batches loaded in advance by each dataloader worker",
+    )
+    parser.add_argument(
+        "--worker-cpu-affinity",
+        nargs="+",
+        type=int,
+        default=None,
+        help="CPU ids for the dataloader workers, each worker is pinned to its share. E.g. 0 1 2 3",
+    )
 
     parser.add_argument(
         "--log-level",
@@ -122,6 +225,13 @@ def parse_args() -> argparse.Namespace:
         choices=["verbose", "info", "warning", "error", "debug"],
         help="Log level",
     )
+    parser.add_argument(
+        "--loss-log-interval",
+        type=int,
+        default=0,
+        help="Log the running training loss every n iterations (0: only per epoch). The losses \
+                        stay on the device in between, logging synchronizes with it",
+    )
 
     parser.add_argument(
         "--notify",
@@ -207,6 +317,87 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument(
         "--pin-memory", default=True, help="pin_memory argument to all dataloaders"
     )
+    parser.add_argument(
+        "--device-prefetch",
+        default=False,
+        action="store_true",
+        help="Move the next batches to the device in the background while the current \
+                        batch is processed",
+    )
+    parser.add_argument(
+        "--uint8-batches",
+        default=False,
+        action="store_true",
+        help="Load training and validation batches as uint8 images and convert them to float \
+                        on the device (implies --batch-augmentation)",
+    )
+    parser.add_argument(
+        "--precompute-pyramid",
+        default=False,
+        action="store_true",
+        help="Compute the multi-scale image pyramids for the loss in the dataloader workers \
+                        (not possible for batches that are augmented or converted on the device)",
+    )
+    parser.add_argument(
+        "--cache-val-in-memory",
+        default=False,
+        action="store_true",
+        help="Keep the validation batches in memory after the first epoch",
+    )
+    parser.add_argument(
+        "--val-cache-budget",
+        type=float,
+        default=4096,
+        help="Memory budget in MiB for --cache-val-in-memory, larger validation sets are \
+                        streamed from the dataloader",
+    )
+    parser.add_argument(
+        "--val-cache-on-device",
+        default=False,
+        action="store_true",
+        help="Keep the cached validation batches on the training device",
+    )
+    parser.add_argument(
+        "--fast-aspp",
+        default=False,
+        action="store_true",
+        help="Project the ASPP branches without concatenating them (same weights and results)",
+    )
+    parser.add_argument(
+        "--concat-free-decoder",
+        default=False,
+        action="store_true",
+        help="Split the decoder conv weights instead of concatenating upconvs, skips and \
+                        disparities (same weights and results)",
+    )
+    parser.add_argument(
+        "--fuse-model",
+        default=False,
+        action="store_true",
+        help="Fold batchnorms into convolutions and use in-place activations for testing",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=None,
+        help="Directory for pre-decoded image caches. If set, all images are decoded and \
+                        resized once into a memory-mapped cache per filenames file.",
+        metavar="DIR",
+    )
+    parser.add_argument(
+        "--shard-dir",
+        default=None,
+        help="Directory with tar shards of the filenames files (created with \
+                        helper-scripts/gen_shards.py). If set, images are streamed from the shards.",
+        metavar="DIR",
+    )
+    parser.add_argument(
+        "--draft-decode",
+        default="none",
+        choices=["none", "strict", "width"],
+        help="Decode JPEGs at a reduced scale close to the input size before resizing. \
+                        strict: never below the input size, width: only the width is kept \
+                        at least at the input width (faster for KITTI, height gets upsampled)",
+    )
     args = parser.parse_args()
 
     # Detect training dataset name
@@ -1,3 +1,4 @@
+import contextlib
 import os
 
 import numpy as np
@@ -5,12 +6,28 @@ import time
 from argparse import Namespace
 
 import torch
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DistributedSampler
 
 from summarytracker import SummaryTracker
-from monolab.data_loader import prepare_dataloader
+from monolab.data_loader import prepare_dataloader, AugmentImageBatch, batch_to_float
 from monolab.loss import MonodepthLoss
 from test import run_test
-from utils import get_model, setup_logging, notify_mail, to_device, time_delta_now
+from utils import (
+    get_model,
+    setup_logging,
+    notify_mail,
+    to_device,
+    time_delta_now,
+    DevicePrefetcher,
+    InMemoryLoader,
+    LossAccumulator,
+    split_batch,
+    distributed_rank,
+    gather_object,
+    rng_state,
+    set_rng_state,
+)
 import logging
 
 
@@ -37,6 +54,10 @@ class Experiment:
         self.args = args
         self.base_dir = base_dir
 
+        # Process group of a distributed run (set up by main.py)
+        self.rank, self.world_size = distributed_rank()
+        self.distributed = self.world_size > 1
+
         self.loss_names = dict(
             full="monodepth-loss",
             images="image-loss",
@@ -46,12 +67,21 @@ class Experiment:
 
         # Setup summary tracker
         self.summary = SummaryTracker(
-            metric_names=list(self.loss_names.values()), args=args, base_dir=base_dir
+            metric_names=list(self.loss_names.values()),
+            args=args,
+            base_dir=base_dir,
+            rank=self.rank,
         )
 
         # Get the model
         self.model = self._get_model(args)
 
+        # The processes start with the same weights (broadcast by DistributedDataParallel),
+        # but draw different augmentations
+        if self.distributed:
+            torch.manual_seed(args.seed + self.rank)
+            np.random.seed(args.seed + self.rank)
+
         # Setup loss, optimizer and validation set
         self.loss_function = MonodepthLoss(
             device=self.device,
@@ -65,8 +95,30 @@ class Experiment:
         )
         logger.debug(f"Using optimizer: {self.optimizer}")
 
+        # Mixed precision, float16 gradients need to be scaled to avoid underflows
+        self.amp_dtype = dict(none=None, bf16=torch.bfloat16, fp16=torch.float16)[
+            args.amp
+        ]
+        if args.amp == "fp16" and "cuda" not in self.device:
+            raise ValueError("float16 autocast requires a cuda device, use bf16")
+        self.scaler = torch.cuda.amp.GradScaler(enabled=args.amp == "fp16")
+
         self.dataset_val = args.dataset_name_val
 
+        # Images that are converted or augmented on the device need their pyramids computed there
+        # (all models predict disparities at 4 scales)
+        num_scales = 4
+        self.val_pyramid_scales = 1
+        self.train_pyramid_scales = 1
+        if args.precompute_pyramid and not args.uint8_batches:
+            self.val_pyramid_scales = num_scales
+            if not (args.batch_augmentation and args.do_augmentation):
+                self.train_pyramid_scales = num_scales
+        if args.precompute_pyramid and self.train_pyramid_scales == 1:
+            logger.warning(
+                "Pyramids are computed in the loss for batches that are changed on the device"
+            )
+
         # the validation loader is a train loader but without data augmentation!
         self.val_n_img, self.val_loader = prepare_dataloader(
             root_dir=args.data_dir,
@@ -81,6 +133,16 @@ class Experiment:
             num_workers=args.num_workers,
             dataset=self.dataset_val,
             pin_memory=args.pin_memory,
+            cache_dir=args.cache_dir,
+            shard_dir=args.shard_dir,
+            draft_decode=args.draft_decode,
+            persistent_workers=args.persistent_workers,
+            prefetch_factor=args.prefetch_factor,
+            worker_cpu_affinity=args.worker_cpu_affinity,
+            uint8_batches=args.uint8_batches,
+            pyramid_scales=self.val_pyramid_scales,
+            rank=self.rank,
+            world_size=self.world_size,
         )
         logging.info(f"Using a validation set with {self.val_n_img} images")
 
@@ -103,11 +165,48 @@ class Experiment:
             num_workers=args.num_workers,
             dataset=self.dataset_train,
             pin_memory=args.pin_memory,
+            cache_dir=args.cache_dir,
+            shard_dir=args.shard_dir,
+            draft_decode=args.draft_decode,
+            persistent_workers=args.persistent_workers,
+            prefetch_factor=args.prefetch_factor,
+            worker_cpu_affinity=args.worker_cpu_affinity,
+            batch_augmentation=args.batch_augmentation,
+            uint8_batches=args.uint8_batches,
+            pyramid_scales=self.train_pyramid_scales,
+            rank=self.rank,
+            world_size=self.world_size,
         )
         logging.info(
             f"Using a training data set from {self.dataset_train} with {self.n_img} images"
         )
 
+        # Copy the next batches to the device while the current one is processed
+        if args.device_prefetch:
+            self.loader = DevicePrefetcher(self.loader, self.device)
+            self.val_loader = DevicePrefetcher(self.val_loader, self.device)
+
+        # The validation batches are the same in every epoch
+        if args.cache_val_in_memory:
+            self.val_loader = InMemoryLoader(
+                self.val_loader,
+                budget_mb=args.val_cache_budget,
+                device=self.device if args.val_cache_on_device else None,
+            )
+
+        # Augment whole batches on the training device instead of in the workers
+        self.batch_augmentation = None
+        if args.batch_augmentation or args.uint8_batches:
+            self.batch_augmentation = AugmentImageBatch(
+                args.augment_parameters, args.do_augmentation
+            )
+
+        # Continue an interrupted run
+        self.start_epoch = 1
+        self.best_val_loss = float("Inf")
+        if args.resume:
+            self.resume(args.resume)
+
         if "cuda" in self.device:
             torch.cuda.synchronize()
 
@@ -124,6 +223,10 @@ class Experiment:
         if args.cuda_device_ids[0] == -2:
             self.device = "cpu"
             logger.info("Running experiment on the CPU ...")
+        elif self.distributed:
+            # One GPU per process
+            self.device = f"cuda:{int(os.environ.get('LOCAL_RANK', 0))}"
+            torch.cuda.set_device(self.device)
         else:
             self.device = f"cuda:{args.cuda_device_ids[0]}"
 
@@ -147,8 +250,23 @@ class Experiment:
 
         self.multi_gpu = len(args.cuda_device_ids) > 1 or args.cuda_device_ids[0] == -1
 
+        # The model that is used for validation and testing, which do not need the gradient
+        # synchronization of a distributed run
+        self.network = self.model
+
+        if self.distributed:
+            logger.info(
+                f"Running process {self.rank} of {self.world_size} on {self.device}"
+            )
+            self.model = DistributedDataParallel(
+                self.model.to(self.device),
+                device_ids=None if self.device == "cpu" else [self.device],
+            )
+            # Wrapped like a DataParallel model (state dict of model.module)
+            self.multi_gpu = True
+
         # Check if multiple cuda devices are selected
-        if self.multi_gpu:
+        elif self.multi_gpu:
             num_cuda_devices = torch.cuda.device_count()
 
             if args.cuda_device_ids[0] == -1:
@@ -167,6 +285,7 @@ class Experiment:
                 self.model = torch.nn.DataParallel(
                     self.model, device_ids=cuda_device_ids
                 )
+                self.network = self.model
             else:
                 logger.warning(
                     f"Attempted to run the experiment on multiple GPUs while only {num_cuda_devices} GPU was available"
@@ -175,6 +294,113 @@ class Experiment:
         logger.debug(f"Sending model to device: {self.device}")
         return self.model.to(self.device)
 
+    def _prepare_batch(self, data, augment=False):
+        """ Move a batch to the device and convert and augment it there if needed
+
+        Args:
+            data: batch from self.loader or self.val_loader
+            augment: apply the batch augmentation (training batches)
+
+        Returns:
+            batch on self.device
+        """
+        # --pin-memory is passed on untyped (truthiness decides, as in the DataLoader)
+        non_blocking = bool(self.args.pin_memory) and "cuda" in self.device
+        data = to_device(data, self.device, non_blocking=non_blocking)
+        if self.args.uint8_batches:
+            data = batch_to_float(data)
+        if augment and self.batch_augmentation is not None:
+            data = self.batch_augmentation(data)
+        return data
+
+    def _autocast(self, enabled=True):
+        """ Autocast context for the network and the loss (no-op without mixed precision) """
+        return torch.autocast(
+            "cuda" if "cuda" in self.device else "cpu",
+            dtype=self.amp_dtype,
+            enabled=enabled and self.amp_dtype is not None,
+        )
+
+    def _pyramids(self, data):
+        """ Precomputed image pyramids of a batch for the loss function, if any """
+        if "left_pyramid" in data:
+            return data["left_pyramid"], data["right_pyramid"]
+        return None
+
+    def _optimizer_step(self, n_accumulated=None):
+        """ Update the parameters with the accumulated gradients
+
+        Args:
+            n_accumulated: number of batches whose gradients were accumulated, if it differs from
+                           args.accumulation_steps (the last step of an epoch), the gradients are
+                           rescaled to the mean over these batches
+        """
+        accumulation_steps = self.args.accumulation_steps
+        if n_accumulated is not None and n_accumulated != accumulation_steps:
+            for param in self.model.parameters():
+                if param.grad is not None:
+                    param.grad *= accumulation_steps / n_accumulated
+        self.scaler.step(self.optimizer)
+        self.scaler.update()
+        self.optimizer.zero_grad()
+
+    def _all_reduce_gradients(self):
+        """ Average gradients over the processes that were accumulated without synchronization """
+        for param in self.model.parameters():
+            if param.grad is not None:
+                torch.distributed.all_reduce(param.grad)
+                param.grad /= self.world_size
+
+    def _sync_gradients(self, sync=True):
+        """ Context for the backward passes of a distributed run, the gradients are only
+        all-reduced over the processes in the last backward pass before an optimizer step
+        """
+        if self.distributed and not sync:
+            return self.model.no_sync()
+        return contextlib.nullcontext()
+
+    def _accumulate_gradients(self, data, n_batches, sync=True):
+        """ Forward and backward pass of a batch, split into micro-batches of
+        args.micro_batch_size samples. The loss of every micro-batch is weighted by its share of the
+        batch and divided by n_batches, such that the gradients of n_batches batches add up to the
+        gradient of their mean loss.
+
+        Args:
+            data: prepared batch
+            n_batches: number of batches accumulated for an optimizer step
+            sync: the optimizer step follows this batch (synchronizes the gradients of a
+                  distributed run)
+
+        Returns:
+            losses of the whole batch: loss, image_loss, disp_gradient_loss, lr_loss
+        """
+        batch_size = data["left_image"].size(0)
+        micro_batch_size = self.args.micro_batch_size or batch_size
+        if micro_batch_size < batch_size:
+            micro_batches = split_batch(data, micro_batch_size)
+        else:
+            micro_batches = [data]
+
+        batch_losses = [0.0] * 4
+        for i, micro_batch in enumerate(micro_batches):
+            left = micro_batch["left_image"]
+            right = micro_batch["right_image"]
+            weight = left.size(0) / batch_size
+
+            with self._sync_gradients(sync and i == len(micro_batches) - 1):
+                with self._autocast():
+                    disps = self.model(left)
+                    losses = self.loss_function(
+                        disps, [left, right], pyramids=self._pyramids(micro_batch)
+                    )
+                self.scaler.scale(losses[0] * (weight / n_batches)).backward()
+
+            batch_losses = [
+                total + weight * loss.detach()
+                for total, loss in zip(batch_losses, losses)
+            ]
+        return batch_losses
+
     def train(self) -> None:
         """ Train the model for self.args.epochs epochs
 
@@ -184,61 +410,81 @@ class Experiment:
         train_start_time = time.time()
 
         # Store the best validation loss
-        best_val_loss = float("Inf")
+        best_val_loss = self.best_val_loss
 
         # Start training
         logger.info(
             f"Starting training for {self.args.epochs} epochs on {self.n_img} images"
         )
-        for epoch in range(1, self.args.epochs + 1):
+        for epoch in range(self.start_epoch, self.args.epochs + 1):
             # Adjust learning rate if flag is set
             if self.args.adjust_lr:
                 adjust_learning_rate(self.optimizer, epoch, self.args.learning_rate)
 
             epoch_time = time.time()
 
-            # Init training loss
-            running_loss = 0.0
-            running_image_loss = 0.0
-            running_disp_gradient_loss = 0.0
-            running_lr_loss = 0.0
+            # New order of the distributed training set
+            if isinstance(getattr(self.loader, "sampler", None), DistributedSampler):
+                self.loader.sampler.set_epoch(epoch)
+            if hasattr(self.loader.dataset, "set_epoch"):
+                self.loader.dataset.set_epoch(epoch)
 
-            # Init validation loss
-            running_val_loss = 0.0
-            running_val_image_loss = 0.0
-            running_val_disp_gradient_loss = 0.0
-            running_val_lr_loss = 0.0
+            # Init training and validation losses (kept on the device until the epoch ends)
+            train_losses = LossAccumulator(
+                list(self.loss_names), self.device, world_size=self.world_size
+            )
+            val_losses = LossAccumulator(
+                list(self.loss_names), self.device, world_size=self.world_size
+            )
 
             self.model.train()
 
+            # Number of batches accumulated for the next optimizer step. The loader length is
+            # not used, streamed shards can yield more batches than it reports
+            accumulation_steps = self.args.accumulation_steps
+            n_accumulated = 0
+            self.optimizer.zero_grad()
+
             #################
             # Training loop #
             #################
             for iteration, data in enumerate(self.loader):
                 # Load data
-                data = to_device(data, self.device)
-                left = data["left_image"]
-                right = data["right_image"]
-
-                # One optimization iteration
-                self.optimizer.zero_grad()
-                disps = self.model(left)
-                loss, image_loss, disp_gradient_loss, lr_loss = self.loss_function(
-                    disps, [left, right]
+                data = self._prepare_batch(data, augment=True)
+
+                # One optimizer step every accumulation_steps batches
+                n_accumulated += 1
+                losses = self._accumulate_gradients(
+                    data,
+                    n_batches=accumulation_steps,
+                    sync=n_accumulated == accumulation_steps,
                 )
-                loss.backward()
-                self.optimizer.step()
+                if n_accumulated == accumulation_steps:
+                    self._optimizer_step()
+                    n_accumulated = 0
 
                 # Collect training loss
-                running_loss += loss.item()
-                running_image_loss += image_loss.item()
-                running_disp_gradient_loss += disp_gradient_loss.item()
-                running_lr_loss += lr_loss.item()
+                train_losses.add(*losses)
+                if (
+                    self.args.loss_log_interval
+                    and (iteration + 1) % self.args.loss_log_interval == 0
+                ):
+                    logger.info(
+                        f"Epoch [{epoch}/{self.args.epochs}] iteration "
+                        f"[{iteration + 1}/{len(self.loader)}] "
+                        f"loss: {train_losses.means()['full']:.4f}"
+                    )
 
                 # Stop after 10 batches if overfitting is enabled
                 if self.args.overfit and iteration >= 5:
                     break
 
+            # The last batches of the epoch, accumulated without synchronization
+            if n_accumulated > 0:
+                if self.distributed:
+                    self._all_reduce_gradients()
+                self._optimizer_step(n_accumulated)
+
             # Training finished #
             logger.info(
                 f"Epoch [{epoch}/{self.args.epochs}] time: {time_delta_now(epoch_time)} s"
@@ -251,19 +497,17 @@ class Experiment:
             val_time = time.time()
             with torch.no_grad():
                 for iteration, data in enumerate(self.val_loader):
-                    data = to_device(data, self.device)
+                    data = self._prepare_batch(data)
                     left = data["left_image"]
                     right = data["right_image"]
-                    disps = self.model(left)
-                    loss, image_loss, disp_gradient_loss, lr_loss = self.loss_function(
-                        disps, [left, right]
-                    )
+                    with self._autocast():
+                        disps = self.network(left)
+                        loss, image_loss, disp_gradient_loss, lr_loss = self.loss_function(
+                            disps, [left, right], pyramids=self._pyramids(data)
+                        )
 
                     # Collect validation loss
-                    running_val_loss += loss.item()
-                    running_val_image_loss += image_loss.item()
-                    running_val_disp_gradient_loss += disp_gradient_loss.item()
-                    running_val_lr_loss += lr_loss.item()
+                    val_losses.add(loss, image_loss, disp_gradient_loss, lr_loss)
 
                     # Stop after 10 batches if overfitting is enabled
                     if self.args.overfit and iteration >= 5:
@@ -273,53 +517,47 @@ class Experiment:
             #################
             # Track results #
             #################
-            running_val_loss /= len(self.val_loader)
-            running_val_image_loss /= len(self.val_loader)
-            running_val_disp_gradient_loss /= len(self.val_loader)
-            running_val_lr_loss /= len(self.val_loader)
+            val_metrics = val_losses.means()
 
             # Generate 10 random disparity map predictions
-            self.gen_val_disp_maps(epoch)
+            if self.rank == 0:
+                self.gen_val_disp_maps(epoch)
+
+            # Check the effect of mixed precision on the validation loss
+            if self.amp_dtype is not None and self.rank == 0:
+                self.summary.add_scalar(
+                    epoch=epoch,
+                    value=self.amp_val_loss_delta(),
+                    tag="amp/val-loss-delta",
+                )
 
-            # Estimate loss per image
-            running_loss /= len(self.loader)
-            running_image_loss /= len(self.loader)
-            running_disp_gradient_loss /= len(self.loader)
-            running_lr_loss /= len(self.loader)
+            # Estimate loss per image (mean over the batches that were actually loaded, streamed
+            # shards can yield more batches than len(self.loader))
+            train_metrics = train_losses.means()
 
             # Update best loss
-            if running_val_loss < best_val_loss:
-                best_val_loss = running_val_loss
-
-            self.summary.add_epoch_metric(
-                epoch=epoch,
-                train_metric=running_loss,
-                val_metric=running_val_loss,
-                metric_name=self.loss_names["full"],
-            )
-            self.summary.add_epoch_metric(
-                epoch=epoch,
-                train_metric=running_image_loss,
-                val_metric=running_val_image_loss,
-                metric_name=self.loss_names["images"],
-            )
-            self.summary.add_epoch_metric(
-                epoch=epoch,
-                train_metric=running_disp_gradient_loss,
-                val_metric=running_val_disp_gradient_loss,
-                metric_name=self.loss_names["disp_gp"],
-            )
-            self.summary.add_epoch_metric(
-                epoch=epoch,
-                train_metric=running_lr_loss,
-                val_metric=running_val_lr_loss,
-                metric_name=self.loss_names["lr_consistency"],
-            )
+            if val_metrics["full"] < best_val_loss:
+                best_val_loss = val_metrics["full"]
+
+            for key, metric_name in self.loss_names.items():
+                self.summary.add_epoch_metric(
+                    epoch=epoch,
+                    train_metric=train_metrics[key],
+                    val_metric=val_metrics[key],
+                    metric_name=metric_name,
+                )
 
             self.summary.add_checkpoint(
-                model=self.model, val_loss=running_val_loss, multi_gpu=self.multi_gpu
+                model=self.model, val_loss=val_metrics["full"], multi_gpu=self.multi_gpu
             )
 
+            # Full training state to resume from
+            interval = self.args.checkpoint_interval
+            if interval and (epoch % interval == 0 or epoch == self.args.epochs):
+                self.summary.add_training_state(
+                    self.training_state(epoch, best_val_loss)
+                )
+
         logging.info(f"Finished Training. Best loss: {best_val_loss}")
         self.summary.save()
 
@@ -343,17 +581,19 @@ class Experiment:
                     break
 
                 # Get the inputs
-                data = to_device(data, self.device)
+                data = self._prepare_batch(data)
                 left = data["left_image"]
                 # Do a forward pass
-                disps = self.model(left)
+                with self._autocast():
+                    disps = self.network(left)
 
-                while gen_count < n_gen_images and gen_count < self.args.batch_size:
-                    batch_idx = gen_count % self.args.batch_size
+                # The batch can be smaller than args.batch_size (e.g. the last of a shard)
+                while gen_count < n_gen_images and gen_count < left.size(0):
+                    batch_idx = gen_count % left.size(0)
                     largest_disp_map = disps[0]
                     image_in_batch = largest_disp_map[batch_idx]
                     left_disp = image_in_batch[0]
-                    d = left_disp.cpu().numpy()
+                    d = left_disp.float().cpu().numpy()
                     self.summary.add_disparity_map(
                         epoch=epoch,
                         disp=torch.Tensor(d),
@@ -362,6 +602,89 @@ class Experiment:
                     )
                     gen_count += 1
 
+    def amp_val_loss_delta(self) -> float:
+        """ Difference between the mixed precision and the float32 validation loss on a fixed
+        subset of the validation set (the first args.amp_check_images images)
+
+        Returns:
+            mean loss difference per batch (mixed precision - float32)
+        """
+        n_images = 0
+        n_batches = 0
+        delta = 0.0
+        with torch.no_grad():
+            for data in self.val_loader:
+                if n_images >= self.args.amp_check_images:
+                    break
+                data = self._prepare_batch(data)
+                left = data["left_image"]
+                right = data["right_image"]
+
+                losses = []
+                for enabled in (True, False):
+                    with self._autocast(enabled):
+                        disps = self.network(left)
+                        loss = self.loss_function(
+                            disps, [left, right], pyramids=self._pyramids(data)
+                        )[0]
+                    losses.append(loss.item())
+
+                delta += losses[0] - losses[1]
+                n_images += left.size(0)
+                n_batches += 1
+        return delta / max(n_batches, 1)
+
+    def training_state(self, epoch: int, best_val_loss: float) -> dict:
+        """ Everything needed to continue the training after an epoch (see resume). In a
+        distributed run, this has to be called by all processes.
+
+        Args:
+            epoch: last finished epoch
+            best_val_loss: best validation loss so far
+
+        Returns:
+            state dict with the model, optimizer, grad scaler and summary states and the random
+            number generator states of all processes
+        """
+        model = self.model.module if self.multi_gpu else self.model
+        return dict(
+            epoch=epoch,
+            best_val_loss=best_val_loss,
+            model=model.state_dict(),
+            optimizer=self.optimizer.state_dict(),
+            scaler=self.scaler.state_dict(),
+            summary=self.summary.state_dict(),
+            rng=gather_object(rng_state()),
+        )
+
+    def resume(self, path: str) -> None:
+        """ Restore a training state saved by training_state, the training continues with the
+        following epoch
+
+        Args:
+            path: path to the training state (checkpoints/training-state.pth)
+
+        Returns:
+            None
+        """
+        logger.info(f"Resuming the training from {path}")
+        state = torch.load(path, map_location="cpu")
+
+        model = self.model.module if self.multi_gpu else self.model
+        model.load_state_dict(state["model"])
+        self.optimizer.load_state_dict(state["optimizer"])
+        self.scaler.load_state_dict(state["scaler"])
+        self.summary.load_state_dict(state["summary"])
+        self.start_epoch = state["epoch"] + 1
+        self.best_val_loss = state["best_val_loss"]
+
+        if len(state["rng"]) != self.world_size:
+            logger.warning(
+                f"The training state was saved by {len(state['rng'])} processes, the random "
+                f"numbers differ from the interrupted run"
+            )
+        set_rng_state(state["rng"][self.rank % len(state["rng"])])
+
     def save(self, path: str) -> None:
         """ Save a .pth state dict from self.model
 
@@ -390,7 +713,7 @@ class Experiment:
     def test(self):
         # Run test
         self.test_result, self.test_result_pp = run_test(
-            model=self.model,
+            model=self.network,
             args=self.args,
             device=self.device,
             result_dir=os.path.join(self.base_dir, "test"),
@@ -0,0 +1,282 @@
+import argparse
+import json
+import logging
+import os
+import time
+
+import torch
+
+from monolab.networks.fusion import fuse_model
+from run_exported import load_artifact
+from utils import get_model, setup_logging
+
+logger = logging.getLogger(__name__)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="PyTorch Monolab Export: Monodepth x " "DeepLabv3+"
+    )
+    parser.add_argument(
+        "--model",
+        default="resnet18_md",
+        help="Model type: deeplab, resnet50_md, resnet18_md, vgg_md, aspp_net or dummy",
+    )
+    parser.add_argument("--model-path", help="Path to a trained model (state dict)")
+    parser.add_argument(
+        "--output",
+        default="model.pt",
+        help="Path of the exported TorchScript module",
+        metavar="FILE",
+    )
+    parser.add_argument(
+        "--onnx",
+        default=None,
+        help="Additionally export an ONNX model to this path",
+        metavar="FILE",
+    )
+    parser.add_argument(
+        "--output-stride", type=int, default=64, help="Output stride after the encoder"
+    )
+    parser.add_argument(
+        "--atrous-rates",
+        nargs="+",
+        type=int,
+        default=[1, 6, 12, 18],
+        help="Atrous rates for the ASPP Module.",
+    )
+    parser.add_argument(
+        "--encoder-dilations",
+        nargs="+",
+        type=int,
+        default=[1, 1, 1, 1],
+        help="Atrous rates used in the encoder's resblocks",
+    )
+    parser.add_argument(
+        "--disable-skip-connections",
+        default=False,
+        action="store_true",
+        help="Flag to add skip connections from the encoder to the decoder.",
+    )
+    parser.add_argument(
+        "--disable-aspp-global-avg-pooling",
+        default=False,
+        action="store_true",
+        help="Flag to disable global average pooling.",
+    )
+    parser.add_argument("--input-height", type=int, help="input height", default=256)
+    parser.add_argument("--input-width", type=int, help="input width", default=512)
+    parser.add_argument(
+        "--input-channels",
+        default=3,
+        type=int,
+        help="Number of channels in input tensor",
+    )
+    parser.add_argument(
+        "--batch-size",
+        default=2,
+        type=int,
+        help="Batch size the module is specialized for (2 = image and flipped image for \
+                        post-processing, as in test.py)",
+    )
+    parser.add_argument("--use-multiple-gpu", default=False)
+    parser.add_argument(
+        "--fast-aspp",
+        default=False,
+        action="store_true",
+        help="Project the ASPP branches without concatenating them (same weights and results)",
+    )
+    parser.add_argument(
+        "--concat-free-decoder",
+        default=False,
+        action="store_true",
+        help="Split the decoder conv weights instead of concatenating upconvs, skips and \
+                        disparities (same weights and results)",
+    )
+    parser.add_argument(
+        "--no-fuse",
+        default=False,
+        action="store_true",
+        help="Do not fold batchnorms into convolutions before exporting",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=1e-4,
+        help="Maximum absolute difference between the exported and the eager outputs",
+    )
+    parser.add_argument(
+        "--log-level",
+        default="info",
+        choices=["verbose", "info", "warning", "error", "debug"],
+        help="Log level",
+    )
+    parser.add_argument("--log-file", default="monolab.log", help="Log file")
+    args = parser.parse_args()
+    return args
+
+
+def export_torchscript(model, example):
+    """ Trace a model for a fixed input shape and freeze it (weights become constants).
+    The backend specific optimizations are applied when loading (see run_exported.load_artifact),
+    because their prepacked weights cannot be serialized.
+
+    Args:
+        model: model in eval mode
+        example: example input, determines the input shape
+
+    Returns:
+        frozen torch.jit.ScriptModule
+    """
+    with torch.no_grad():
+        traced = torch.jit.trace(model, example, strict=False)
+    return torch.jit.freeze(traced)
+
+
+def export_onnx(model, example, path):
+    """ Export a model to ONNX for a fixed input shape
+
+    Args:
+        model: model in eval mode
+        example: example input, determines the input shape
+        path: output path
+    """
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            example,
+            path,
+            opset_version=11,
+            input_names=["image"],
+            output_names=["disp1", "disp2", "disp3", "disp4"],
+        )
+
+
+def max_difference(outputs, reference):
+    """ Maximum absolute difference between two lists of disparity maps """
+    return max(
+        float((torch.as_tensor(o) - r).abs().max()) for o, r in zip(outputs, reference)
+    )
+
+
+def validate(run, model, shape, n_trials=3):
+    """ Compare an exported model to the eager model on random inputs
+
+    Args:
+        run: callable that runs the exported model on an input tensor
+        model: eager model in eval mode
+        shape: input shape
+        n_trials: number of random inputs
+
+    Returns:
+        maximum absolute difference of all outputs
+    """
+    difference = 0.0
+    with torch.no_grad():
+        for _ in range(n_trials):
+            x = torch.rand(shape)
+            difference = max(difference, max_difference(run(x), model(x)))
+    return difference
+
+
+def benchmark(run, shape, n_runs=5, n_warmup=3):
+    """ Mean latency of a model in ms (TorchScript optimizes the graph during the warmup runs) """
+    x = torch.rand(shape)
+    with torch.no_grad():
+        for _ in range(n_warmup):
+            run(x)
+        start = time.time()
+        for _ in range(n_runs):
+            run(x)
+    return (time.time() - start) / n_runs * 1000
+
+
+def main():
+    args = parse_args()
+    setup_logging(level=args.log_level, filename=args.log_file)
+
+    model = get_model(args.model, n_input_channels=args.input_channels, args=args)
+    if args.use_multiple_gpu:
+        model = torch.nn.DataParallel(model)
+    if args.model_path:
+        model.load_state_dict(torch.load(args.model_path, map_location="cpu"))
+    else:
+        logger.warning("No --model-path given, exporting randomly initialized weights")
+    if args.use_multiple_gpu:
+        model = model.module
+    model.eval()
+
+    # The exported model is validated against the unmodified eager model
+    eager = model
+    if not args.no_fuse:
+        model = fuse_model(eager)
+
+    shape = (args.batch_size, args.input_channels, args.input_height, args.input_width)
+    example = torch.rand(shape)
+
+    if args.onnx:
+        try:
+            import onnx
+        except ImportError:
+            raise ImportError("The ONNX export requires the onnx package")
+
+    # TorchScript
+    scripted = export_torchscript(model, example)
+    difference = validate(scripted, eager, shape)
+    logger.info(f"TorchScript max abs difference to eager: {difference:.2e}")
+
+    # Everything the runner needs to know, stored inside the artifact
+    metadata = dict(
+        model=args.model,
+        model_path=args.model_path,
+        input_shape=list(shape),
+        outputs=["disp1", "disp2", "disp3", "disp4"],
+        fused=not args.no_fuse,
+        max_abs_difference=difference,
+        torch_version=torch.__version__,
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    torch.jit.save(
+        scripted, args.output, _extra_files={"metadata.json": json.dumps(metadata)}
+    )
+
+    # Validate the artifact as the runner loads it
+    loaded, _ = load_artifact(args.output)
+    difference = max(difference, validate(loaded, eager, shape))
+    if difference > args.tolerance:
+        os.remove(args.output)
+        raise RuntimeError(
+            f"Exported model deviates from the eager model by {difference} > {args.tolerance}"
+        )
+    logger.info(f"Saved TorchScript module to {args.output}")
+    logger.info(
+        f"Latency on {shape}: eager {benchmark(eager, shape):.0f} ms, "
+        f"TorchScript {benchmark(loaded, shape):.0f} ms"
+    )
+
+    # ONNX
+    if args.onnx:
+        export_onnx(model, example, args.onnx)
+        try:
+            import onnxruntime
+        except ImportError:
+            logger.warning(
+                "onnxruntime is not installed, the ONNX model is not validated"
+            )
+        else:
+            session = onnxruntime.InferenceSession(
+                args.onnx, providers=["CPUExecutionProvider"]
+            )
+            difference = validate(
+                lambda x: session.run(None, {"image": x.numpy()}), eager, shape
+            )
+            logger.info(f"ONNX max abs difference to eager: {difference:.2e}")
+            if difference > args.tolerance:
+                raise RuntimeError(
+                    f"ONNX model deviates from the eager model by {difference} > {args.tolerance}"
+                )
+        logger.info(f"Saved ONNX model to {args.onnx}")
+
+
+if __name__ == "__main__":
+    main()
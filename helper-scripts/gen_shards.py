@@ -0,0 +1,60 @@
+import argparse
+import logging
+
+from monolab.data_loader.shards import shard_path, write_shards
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Pack the images of filenames files into tar shards for streaming"
+    )
+
+    parser.add_argument(
+        "--data-dir",
+        default="/visinf/projects_students/monolab/data/kitti",
+        help="path to the dataset folder. \
+                        The filenames given in filenames_file \
+                        are relative to this path.",
+        metavar="DIR",
+    )
+    parser.add_argument(
+        "--filenames-files",
+        nargs="+",
+        help="Filenames files (kitti, cityscapes, synthia, vkitti) to pack. \
+                        Each line should contain left and right image paths \
+                        separated by a space.",
+        metavar="FILE",
+    )
+    parser.add_argument(
+        "--shard-dir",
+        help="Output directory, the shards of each filenames file are written into \
+                        a subdirectory named after the filenames file. Pass the same \
+                        directory to main.py/test.py as --shard-dir.",
+        metavar="DIR",
+    )
+    parser.add_argument(
+        "--samples-per-shard",
+        type=int,
+        default=1000,
+        help="Number of image pairs per shard",
+    )
+
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    for filenames_file in args.filenames_files:
+        write_shards(
+            root_dir=args.data_dir,
+            filenames_file=filenames_file,
+            output_dir=shard_path(args.shard_dir, filenames_file),
+            samples_per_shard=args.samples_per_shard,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -16,6 +16,8 @@ from matplotlib import cm
 
 from scipy.interpolate import LinearNDInterpolator
 
+from monolab.loss import base_grid
+
 toPILImage = transforms.ToPILImage()
 toTensor = transforms.ToTensor()
 
@@ -300,13 +302,8 @@ def apply_disparity(img, disp):
     img = transforms.ToTensor()(img).unsqueeze(0)
     disp = torch.tensor(disp)
 
-    device = torch.device("cpu")
-
     # Original coordinates of pixels
-    x_base = torch.linspace(0, 1, width).repeat(1, height, 1).type_as(img).to(device)
-    y_base = (
-        torch.linspace(0, 1, height).repeat(1, width, 1).transpose(1, 2).type_as(img)
-    ).to(device)
+    x_base, y_base = base_grid(height, width, img.dtype, img.device)
 
     # Apply shift in X direction
     x_shifts = disp[:, :]  # Disparity is passed in NCHW format with 1 channel
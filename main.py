@@ -2,9 +2,11 @@ import datetime
 import os
 import logging
 
+import torch
+
 from args import parse_args
 from experiment import Experiment, setup_logging
-from utils import notify_mail
+from utils import notify_mail, init_distributed, broadcast_object
 import traceback
 from eval.eval_utils import results_to_csv_str
 
@@ -14,9 +16,18 @@ logger = logging.getLogger(__name__)
 def main():
     args = parse_args()
 
+    # Join the other processes of a distributed run
+    rank = 0
+    if args.distributed:
+        rank, _ = init_distributed(args.dist_backend)
+
     # Generate base path: ".../$(args.output_dir)/run-$(date)-$(tag)"
-    base_dir = generate_run_base_dir(args.model, args.tag, args.output_dir)
-    log_file = os.path.join(base_dir, "log.txt")
+    # (shared by all processes of a distributed run)
+    base_dir = None
+    if rank == 0:
+        base_dir = generate_run_base_dir(args.model, args.tag, args.output_dir)
+    base_dir = broadcast_object(base_dir)
+    log_file = os.path.join(base_dir, "log.txt" if rank == 0 else f"log-{rank}.txt")
 
     # Setup logging in base_dir/log.txt
     setup_logging(level=args.log_level, filename=log_file)
@@ -26,6 +37,10 @@ def main():
         # Run experiment
         experiment = Experiment(args, base_dir=base_dir)
         experiment.train()
+
+        # Only the first process tests and reports
+        if rank != 0:
+            return
         experiment.test()
 
         test_res_str = results_to_csv_str(
@@ -57,7 +72,7 @@ def main():
         logger.error(errormsg)
 
         # Notify exception
-        if args.notify:
+        if args.notify and rank == 0:
             subject = f"[MONOLAB {args.tag}] Training Error!"
             message = (
                 f"The experiment in {base_dir} has failed. An error occurred "
@@ -68,6 +83,9 @@ def main():
             )
 
         raise e
+    finally:
+        if args.distributed:
+            torch.distributed.destroy_process_group()
 
 
 def generate_run_base_dir(model_name: str, tag: str, output_dir: str) -> str:
@@ -1 +1,2 @@
 from .data_loader import prepare_dataloader
+from .transforms import AugmentImageBatch, batch_to_float
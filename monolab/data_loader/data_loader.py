@@ -1,11 +1,23 @@
+import hashlib
+import json
 import logging
 import os
 import random
 
-from PIL import Image
+import numpy as np
 
-from torch.utils.data import Dataset, DataLoader
-from .transforms import image_transforms, crop_cityscapes
+import torchvision.transforms as transforms
+from torch.utils.data import Dataset, DataLoader, DistributedSampler, get_worker_info
+from .manifest import load_manifest
+from .shards import ShardedImageLoader, shard_path
+from .transforms import (
+    image_transforms,
+    open_image,
+    decode_draft_size,
+    ResizeImage,
+    ToArray,
+    ScalePyramid,
+)
 
 
 logger = logging.getLogger(__name__)
@@ -27,6 +39,7 @@ class ImageLoader(Dataset):
         seed=9001,
         transform=None,
         dataset="kitti",
+        draft_size=None,
     ):
         """ Setup a Kitti sequence dataset.
 
@@ -37,49 +50,58 @@ class ImageLoader(Dataset):
             shuffle: shuffle the dataset beforehand (fixed permutation)
             seed: (int) random seed for the permutation
             transform: a torchvision.transforms type transform
+            dataset: dataset name, e.g. "kitti" or "cityscapes"
+            draft_size: (width, height) minimum size for reduced-resolution JPEG decoding
         """
 
-        with open(filenames_file) as filenames:
-            self.left_paths = sorted(
-                os.path.join(root_dir, fname.split()[0]) for fname in filenames
-            )
+        # Parsed once per filenames file and shared between all loaders of this process
+        self.manifest = load_manifest(filenames_file)
+        self.root_dir = root_dir
 
-        if mode == "train" or mode == "val":
-            with open(filenames_file) as filenames:
-                self.right_paths = sorted(
-                    os.path.join(root_dir, fname.split()[1]) for fname in filenames
-                )
+        if (mode == "train" or mode == "val") and not self.manifest.has_right:
+            raise ValueError(f"{filenames_file} contains no right images")
 
+        self.perm = None
         if shuffle:
-            perm = list(range(len(self.left_paths)))
+            self.perm = list(range(len(self.manifest)))
             random.seed(seed)
-            random.shuffle(perm)
-
-            self.left_paths = [self.left_paths[i] for i in perm]
-
-            if mode == "train" or mode == "val":
-                self.right_paths = [self.right_paths[i] for i in perm]
+            random.shuffle(self.perm)
 
         self.transform = transform
         self.mode = mode
         self.dataset = dataset
+        self.draft_size = draft_size
+
+    @property
+    def left_paths(self):
+        return [self.left_path(i) for i in range(len(self))]
+
+    @property
+    def right_paths(self):
+        return [self.right_path(i) for i in range(len(self))]
+
+    def left_path(self, idx):
+        if self.perm is not None:
+            idx = self.perm[idx]
+        return os.path.join(self.root_dir, self.manifest.left(idx))
+
+    def right_path(self, idx):
+        if self.perm is not None:
+            idx = self.perm[idx]
+        return os.path.join(self.root_dir, self.manifest.right(idx))
 
     def __len__(self):
-        return len(self.left_paths)
+        return len(self.manifest)
 
     def __getitem__(self, idx):
 
-        left_image = Image.open(self.left_paths[idx])
-
-        if self.dataset == "cityscapes":
-            left_image = crop_cityscapes(left_image)
+        left_image = open_image(self.left_path(idx), self.dataset, self.draft_size)
 
         if self.mode == "train" or self.mode == "val":
 
-            right_image = Image.open(self.right_paths[idx])
-
-            if self.dataset == "cityscapes":
-                right_image = crop_cityscapes(right_image)
+            right_image = open_image(
+                self.right_path(idx), self.dataset, self.draft_size
+            )
 
             sample = {"left_image": left_image, "right_image": right_image}
 
@@ -94,6 +116,262 @@ class ImageLoader(Dataset):
             return left_image
 
 
+class CachedImageLoader(Dataset):
+    """ DataSet that serves pre-decoded and resized images from an image cache
+        (see build_image_cache). Behaves like ImageLoader, but the elements are uint8
+        numpy arrays (HxWxC) that are slices of a memory-mapped file instead of PIL images.
+    """
+
+    def __init__(self, cache_path, mode, shuffle=False, seed=9001, transform=None):
+        """ Setup a cached dataset.
+
+        Args:
+            cache_path: path to the .npy image cache file
+            mode: 'train', 'val' or 'test'
+            shuffle: shuffle the dataset beforehand (fixed permutation)
+            seed: (int) random seed for the permutation
+            transform: a torchvision.transforms type transform (without resizing)
+        """
+        with open(_cache_index_path(cache_path)) as f:
+            self.index = json.load(f)
+
+        if (mode == "train" or mode == "val") and self.index["views"] < 2:
+            raise ValueError(
+                f"Image cache {cache_path} contains no right images, "
+                f"it cannot be used in {mode} mode"
+            )
+
+        self.cache_path = cache_path
+        self.n_img = self.index["num_images"]
+
+        # Same fixed permutation as ImageLoader
+        self.perm = None
+        if shuffle:
+            self.perm = list(range(self.n_img))
+            random.seed(seed)
+            random.shuffle(self.perm)
+
+        self.transform = transform
+        self.mode = mode
+
+        # The memory map is opened lazily, such that every worker process maps the
+        # file itself instead of receiving a pickled copy of it
+        self.images = None
+
+    def __len__(self):
+        return self.n_img
+
+    def __getitem__(self, idx):
+        if self.images is None:
+            # Copy-on-write mapping: zero-copy slices that are still writable
+            self.images = np.load(self.cache_path, mmap_mode="c")
+
+        if self.perm is not None:
+            idx = self.perm[idx]
+
+        views = self.images[idx]
+        left_image = views[0]
+
+        if self.mode == "train" or self.mode == "val":
+            sample = {"left_image": left_image, "right_image": views[1]}
+        else:
+            sample = left_image
+
+        if self.transform:
+            sample = self.transform(sample)
+        return sample
+
+
+def image_cache_path(cache_dir, filenames_file, size):
+    """ Get the image cache location for a filenames file and image size
+
+    Args:
+        cache_dir: directory that contains all image caches
+        filenames_file: file, where each line contains left and right image paths
+        size: (tuple) height and width of the cached images
+
+    Returns:
+        path to the .npy image cache file
+    """
+    name = os.path.splitext(os.path.basename(filenames_file))[0]
+    # Filenames files with the same name in different directories get their own cache
+    path_hash = hashlib.md5(os.path.abspath(filenames_file).encode()).hexdigest()[:8]
+    return os.path.join(cache_dir, f"{name}_{path_hash}_{size[0]}x{size[1]}.npy")
+
+
+def _cache_index_path(cache_path):
+    return os.path.splitext(cache_path)[0] + ".json"
+
+
+def _is_valid_image_cache(
+    cache_path, filenames_file, root_dir, size, dataset, draft_decode
+):
+    """ Check whether a complete image cache with matching parameters exists, that was built
+        from the current version of the filenames file
+    """
+    index_path = _cache_index_path(cache_path)
+    if not os.path.exists(cache_path) or not os.path.exists(index_path):
+        return False
+
+    with open(index_path) as f:
+        index = json.load(f)
+
+    manifest = load_manifest(filenames_file)
+    valid = (
+        index["filenames_file"] == os.path.abspath(filenames_file)
+        and index.get("source_stamp") == manifest._source_stamp().tolist()
+        and index["num_images"] == len(manifest)
+        and index["root_dir"] == os.path.abspath(root_dir)
+        and index["size"] == list(size)
+        and index["dataset"] == dataset
+        and index.get("draft_decode", "none") == draft_decode
+    )
+    if not valid:
+        logger.warning(f"Image cache {cache_path} is outdated and will be rebuilt")
+    return valid
+
+
+def build_image_cache(
+    root_dir,
+    filenames_file,
+    cache_path,
+    size=(256, 512),
+    dataset="kitti",
+    num_workers=1,
+    draft_decode="none",
+):
+    """ Decode, crop and resize all images of a filenames file once and store them as uint8
+        in a single memory-mapped .npy file of shape (n_img, views, height, width, 3), where
+        views is 2 (left and right) or 1 (only left images available). An index with the
+        image paths and parameters is written next to it as .json.
+
+    Args:
+        root_dir: data directory
+        filenames_file: file, where each line contains left and right image paths (separated by whitespace)
+        cache_path: path to the .npy image cache file
+        size: (tuple) height and width of the cached images
+        dataset: dataset name, e.g. "kitti" or "cityscapes"
+        num_workers: number of workers used for decoding
+        draft_decode: reduced-resolution JPEG decoding mode (see transforms.decode_draft_size)
+    """
+    manifest = load_manifest(filenames_file)
+    has_right = manifest.has_right
+    # Modification time and size of the filenames file, before the images are read
+    source_stamp = manifest._source_stamp().tolist()
+
+    # Decode with the regular loader, val mode keeps the left/right pairs
+    mode = "val" if has_right else "test"
+    image_data_set = ImageLoader(
+        root_dir,
+        filenames_file,
+        mode=mode,
+        transform=transforms.Compose(
+            [ResizeImage(train=has_right, size=size), ToArray(train=has_right)]
+        ),
+        dataset=dataset,
+        draft_size=decode_draft_size(size, draft_decode),
+    )
+    n_img = len(image_data_set)
+    views = 2 if has_right else 1
+
+    logger.info(f"Building image cache {cache_path} from {n_img} images")
+    os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+
+    # Write into temporary files and move them in place when complete
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    images = np.lib.format.open_memmap(
+        tmp_path, mode="w+", dtype=np.uint8, shape=(n_img, views, size[0], size[1], 3)
+    )
+
+    batch_size = 32
+    loader = DataLoader(image_data_set, batch_size=batch_size, num_workers=num_workers)
+    for i, data in enumerate(loader):
+        batch = slice(i * batch_size, i * batch_size + batch_size)
+        if has_right:
+            images[batch, 0] = data["left_image"].numpy()
+            images[batch, 1] = data["right_image"].numpy()
+        else:
+            images[batch, 0] = data.numpy()
+
+    images.flush()
+    del images
+
+    index = dict(
+        filenames_file=os.path.abspath(filenames_file),
+        source_stamp=source_stamp,
+        root_dir=os.path.abspath(root_dir),
+        dataset=dataset,
+        size=list(size),
+        draft_decode=draft_decode,
+        num_images=n_img,
+        views=views,
+        left_paths=image_data_set.left_paths,
+    )
+    tmp_index_path = f"{_cache_index_path(cache_path)}.{os.getpid()}.tmp"
+    with open(tmp_index_path, "w") as f:
+        json.dump(index, f)
+
+    os.replace(tmp_path, cache_path)
+    os.replace(tmp_index_path, _cache_index_path(cache_path))
+
+
+class WorkerAffinity(object):
+    """ worker_init_fn that pins each dataloader worker process to its share of a list of CPUs
+    """
+
+    def __init__(self, cpus):
+        """
+        Args:
+            cpus: list of CPU ids that are distributed over the workers, ids that this process
+                  may not use are ignored
+
+        Raises:
+            ValueError: if this process may not use any of the CPUs
+        """
+        self.cpus = list(cpus)
+
+        if hasattr(os, "sched_getaffinity"):
+            allowed = os.sched_getaffinity(0)
+            unavailable = [cpu for cpu in self.cpus if cpu not in allowed]
+            self.cpus = [cpu for cpu in self.cpus if cpu in allowed]
+            if not self.cpus:
+                raise ValueError(
+                    f"None of the worker CPUs {list(cpus)} can be used, "
+                    f"available CPUs: {sorted(allowed)}"
+                )
+            if unavailable:
+                logger.warning(
+                    f"Ignoring worker CPUs {unavailable}, which this process may not use"
+                )
+
+    def __call__(self, worker_id):
+        num_workers = get_worker_info().num_workers
+        if len(self.cpus) >= num_workers:
+            cpus = self.cpus[worker_id::num_workers]
+        else:
+            cpus = [self.cpus[worker_id % len(self.cpus)]]
+
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, cpus)
+        else:
+            logger.warning("Setting the CPU affinity is not supported on this platform")
+
+
+def _worker_kwargs(
+    num_workers, persistent_workers, prefetch_factor, worker_cpu_affinity
+):
+    """ DataLoader arguments for the worker processes (only valid with num_workers > 0) """
+    if num_workers == 0:
+        return {}
+
+    kwargs = dict(
+        persistent_workers=persistent_workers, prefetch_factor=prefetch_factor
+    )
+    if worker_cpu_affinity:
+        kwargs["worker_init_fn"] = WorkerAffinity(worker_cpu_affinity)
+    return kwargs
+
+
 def prepare_dataloader(
     root_dir,
     filenames_file,
@@ -107,6 +385,17 @@ def prepare_dataloader(
     num_workers=1,
     dataset="kitti",
     pin_memory=True,
+    cache_dir=None,
+    batch_augmentation=False,
+    shard_dir=None,
+    draft_decode="none",
+    persistent_workers=False,
+    prefetch_factor=2,
+    worker_cpu_affinity=None,
+    uint8_batches=False,
+    pyramid_scales=1,
+    rank=0,
+    world_size=1,
 ):
     """ Prepares a DataLoader that loads Kitti images from file names and performs transforms
 
@@ -125,6 +414,30 @@ def prepare_dataloader(
         batch_size: number of images per batch
         size: (tuple) x and y dimension of input images (inputs are rescaled to this dimension)
         num_workers: number of workers in the data loader
+        dataset: dataset name, e.g. "kitti" or "cityscapes"
+        pin_memory: copy batches into pinned memory
+        cache_dir: directory for pre-decoded image caches. If set, the images are decoded and resized
+                once into a memory-mapped cache (built on first use) and served from there
+        batch_augmentation: leave flipping and photometric augmentation out of the worker pipeline,
+                because it is applied batch-wise afterwards (see AugmentImageBatch)
+        shard_dir: directory with tar shards of the filenames files (see helper-scripts/gen_shards.py).
+                If set, the images are streamed sequentially from the shards of this filenames file
+        draft_decode: "none", "strict" or "width", let the JPEG decoder decode at a reduced scale close
+                to size before the final resize (see transforms.decode_draft_size). Output shapes are unchanged
+        persistent_workers: keep the worker processes alive between iterations over the loader
+        prefetch_factor: number of batches loaded in advance by each worker
+        worker_cpu_affinity: list of CPU ids, the workers are pinned to their share of them
+        uint8_batches: ("train" and "val" only) batches contain uint8 images (n_batch, h, w, 3) that
+                have to be converted with transforms.batch_to_float, which shrinks the transfer from
+                the workers and to the device by 4x. Implies batch_augmentation
+        pyramid_scales: ("train" and "val" only) if > 1, the workers add the lower levels of the
+                image pyramids with this many scales to the samples (see transforms.ScalePyramid), such
+                that the loss does not have to compute them. Not possible when the images are changed
+                afterwards (uint8_batches or batch_augmentation with do_augmentation)
+        rank: rank of this process in a distributed run
+        world_size: number of processes of a distributed run. If > 1, every process loads its
+                share of the dataset (a DistributedSampler, call loader.sampler.set_epoch(epoch) for
+                a new order in every epoch; with shards, every process reads its share of the shards)
 
     Returns:
         n_img : int
@@ -137,26 +450,87 @@ def prepare_dataloader(
     data_transform = image_transforms(
         mode=mode,
         augment_parameters=augment_parameters,
-        do_augmentation=do_augmentation,
+        do_augmentation=do_augmentation and not (batch_augmentation or uint8_batches),
         size=size,
+        resize=cache_dir is None,
+        uint8=uint8_batches,
     )
 
-    image_data_set = ImageLoader(
-        root_dir,
-        filenames_file,
-        mode=mode,
-        shuffle=shuffle_before,
-        transform=data_transform,
-        dataset=dataset,
-    )
+    if pyramid_scales > 1:
+        if mode == "test" or uint8_batches or (batch_augmentation and do_augmentation):
+            raise ValueError(
+                "Pyramids can only be precomputed for float images that are final"
+            )
+        data_transform = transforms.Compose(
+            [data_transform, ScalePyramid(pyramid_scales)]
+        )
+
+    if cache_dir is not None and shard_dir is not None:
+        raise ValueError("Use either an image cache or shards, not both")
+
+    if shard_dir is not None:
+        # Shuffling happens in the streaming dataset, shuffle_before gives a fixed order
+        image_data_set = ShardedImageLoader(
+            shard_path(shard_dir, filenames_file),
+            mode=mode,
+            shuffle=shuffle or shuffle_before,
+            seed=None if shuffle else 9001,
+            transform=data_transform,
+            dataset=dataset,
+            batch_size=batch_size,
+            draft_size=decode_draft_size(size, draft_decode),
+            rank=rank,
+            world_size=world_size,
+        )
+        shuffle = False
+    elif cache_dir is not None:
+        cache_path = image_cache_path(cache_dir, filenames_file, size)
+        if not _is_valid_image_cache(
+            cache_path, filenames_file, root_dir, size, dataset, draft_decode
+        ):
+            build_image_cache(
+                root_dir,
+                filenames_file,
+                cache_path,
+                size=size,
+                dataset=dataset,
+                num_workers=num_workers,
+                draft_decode=draft_decode,
+            )
+
+        image_data_set = CachedImageLoader(
+            cache_path, mode=mode, shuffle=shuffle_before, transform=data_transform
+        )
+    else:
+        image_data_set = ImageLoader(
+            root_dir,
+            filenames_file,
+            mode=mode,
+            shuffle=shuffle_before,
+            transform=data_transform,
+            dataset=dataset,
+            draft_size=decode_draft_size(size, draft_decode),
+        )
 
     n_img = len(image_data_set)
 
+    # Each process of a distributed run loads a different part of the dataset
+    sampler = None
+    if world_size > 1 and shard_dir is None:
+        sampler = DistributedSampler(
+            image_data_set, num_replicas=world_size, rank=rank, shuffle=shuffle
+        )
+        shuffle = False
+
     loader = DataLoader(
         image_data_set,
         batch_size=batch_size,
         shuffle=shuffle,
+        sampler=sampler,
         num_workers=num_workers,
         pin_memory=pin_memory,
+        **_worker_kwargs(
+            num_workers, persistent_workers, prefetch_factor, worker_cpu_affinity
+        ),
     )
     return n_img, loader
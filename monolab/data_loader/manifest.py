@@ -0,0 +1,138 @@
+import logging
+import os
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+# Manifests that have already been loaded in this process, by absolute filenames file path
+_manifests = {}
+
+
+class FilenamesManifest(object):
+    """ Parsed filenames file, where each line contains a left and (optionally) a right image path.
+        The pairs are sorted by their left image path and kept together. All paths of a column are
+        stored as one utf-8 byte buffer plus an offset array, which is compact, cheap to pickle into
+        dataloader workers and can be cached next to the filenames file as .manifest.npz.
+        The file is only parsed on first access.
+    """
+
+    def __init__(self, filenames_file):
+        """
+        Args:
+            filenames_file: file, where each line contains left and right image paths (separated by whitespace)
+        """
+        self.filenames_file = os.path.abspath(filenames_file)
+        self.cache_file = self.filenames_file + ".manifest.npz"
+        self._arrays = None
+
+    @property
+    def arrays(self):
+        if self._arrays is None:
+            self._arrays = self._load()
+        return self._arrays
+
+    @property
+    def has_right(self):
+        return "right_data" in self.arrays
+
+    def __len__(self):
+        return len(self.arrays["left_offsets"]) - 1
+
+    def left(self, idx):
+        """ Relative path of the idx-th left image """
+        return self._get("left", idx)
+
+    def right(self, idx):
+        """ Relative path of the idx-th right image """
+        if not self.has_right:
+            raise ValueError(f"{self.filenames_file} does not contain right images")
+        return self._get("right", idx)
+
+    def _get(self, column, idx):
+        offsets = self.arrays[column + "_offsets"]
+        data = self.arrays[column + "_data"]
+        return data[offsets[idx] : offsets[idx + 1]].tobytes().decode("utf-8")
+
+    def _source_stamp(self):
+        stat = os.stat(self.filenames_file)
+        return np.array([stat.st_mtime_ns, stat.st_size], dtype=np.int64)
+
+    def _load(self):
+        """ Load the cached manifest if it is up to date, else parse the filenames file """
+        stamp = self._source_stamp()
+        if os.path.exists(self.cache_file):
+            try:
+                with np.load(self.cache_file) as cached:
+                    if np.array_equal(cached["stamp"], stamp):
+                        return {k: cached[k] for k in cached.files if k != "stamp"}
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning(f"Ignoring broken manifest {self.cache_file}: {e}")
+
+        arrays = self._parse()
+
+        # Cache the manifest next to the filenames file, if that location is writable
+        tmp_file = f"{self.cache_file}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_file, "wb") as f:
+                np.savez(f, stamp=stamp, **arrays)
+            os.replace(tmp_file, self.cache_file)
+        except OSError as e:
+            logger.debug(f"Could not cache manifest {self.cache_file}: {e}")
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+        return arrays
+
+    def _parse(self):
+        with open(self.filenames_file) as filenames:
+            lines = [line.split() for line in filenames if line.strip()]
+
+        left = np.array([line[0] for line in lines])
+        has_right = len(lines) > 0 and all(len(line) > 1 for line in lines)
+
+        if has_right:
+            right = np.array([line[1] for line in lines])
+            # Sort the pairs by their left path and keep left and right together
+            order = np.lexsort((right, left))
+            left, right = left[order], right[order]
+
+            if not np.array_equal(right, np.sort(right)):
+                logger.warning(
+                    f"{self.filenames_file}: the right images are not in the same order "
+                    f"as their left images, pairs are kept as listed in the file"
+                )
+        else:
+            left = np.sort(left)
+
+        arrays = {}
+        arrays["left_data"], arrays["left_offsets"] = _pack(left)
+        if has_right:
+            arrays["right_data"], arrays["right_offsets"] = _pack(right)
+        return arrays
+
+
+def _pack(paths):
+    """ Pack a list of strings into a utf-8 byte buffer and an offset array """
+    encoded = [p.encode("utf-8") for p in paths]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(e) for e in encoded])
+    data = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+    return data, offsets
+
+
+def load_manifest(filenames_file):
+    """ Get the manifest of a filenames file. Manifests are shared within a process, such that
+        every filenames file is only parsed once, no matter how many loaders use it.
+
+    Args:
+        filenames_file: file, where each line contains left and right image paths (separated by whitespace)
+
+    Returns:
+        FilenamesManifest
+    """
+    key = os.path.abspath(filenames_file)
+    if key not in _manifests:
+        _manifests[key] = FilenamesManifest(filenames_file)
+    return _manifests[key]
@@ -0,0 +1,334 @@
+import io
+import itertools
+import json
+import logging
+import os
+import random
+import tarfile
+
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+
+from .manifest import load_manifest
+from .transforms import open_image
+
+
+logger = logging.getLogger(__name__)
+
+
+def shard_path(shard_dir, filenames_file):
+    """ Get the shard directory for a filenames file
+
+    Args:
+        shard_dir: directory that contains the shards of all filenames files
+        filenames_file: file, where each line contains left and right image paths
+
+    Returns:
+        directory with the shards and their index.json
+    """
+    name = os.path.splitext(os.path.basename(filenames_file))[0]
+    return os.path.join(shard_dir, name)
+
+
+def write_shards(root_dir, filenames_file, output_dir, samples_per_shard=1000):
+    """ Pack the images of a filenames file into large tar shards for sequential reading.
+        The encoded image files are stored as they are (no decoding), sample i consists of the
+        members "<i>.left.<ext>" and "<i>.right.<ext>". Samples are in manifest order, i.e.
+        the same order as in ImageLoader. An index.json lists the shards, their sizes and the
+        byte offset of every sample in its shard.
+
+    Args:
+        root_dir: data directory
+        filenames_file: file, where each line contains left and right image paths (separated by whitespace)
+        output_dir: directory for the shards
+        samples_per_shard: number of samples (image pairs) per shard
+    """
+    manifest = load_manifest(filenames_file)
+    n_img = len(manifest)
+    os.makedirs(output_dir, exist_ok=True)
+
+    columns = [("left", manifest.left)]
+    if manifest.has_right:
+        columns.append(("right", manifest.right))
+
+    shards = []
+    for shard_idx, start in enumerate(range(0, n_img, samples_per_shard)):
+        stop = min(start + samples_per_shard, n_img)
+        name = f"shard-{shard_idx:05d}.tar"
+        tmp_path = os.path.join(output_dir, f"{name}.{os.getpid()}.tmp")
+
+        # Start of every sample in the shard and the end of the last one
+        offsets = []
+        with tarfile.open(tmp_path, "w") as tar:
+            for i in range(start, stop):
+                offsets.append(tar.offset)
+                for view, get_path in columns:
+                    path = get_path(i)
+                    ext = os.path.splitext(path)[1]
+                    tar.add(
+                        os.path.join(root_dir, path), arcname=f"{i:08d}.{view}{ext}"
+                    )
+            offsets.append(tar.offset)
+
+        os.replace(tmp_path, os.path.join(output_dir, name))
+        shards.append(
+            dict(name=name, start=start, num_images=stop - start, offsets=offsets)
+        )
+        logger.info(f"Wrote {name} ({stop}/{n_img} images)")
+
+    index = dict(
+        filenames_file=os.path.abspath(filenames_file),
+        num_images=n_img,
+        has_right=manifest.has_right,
+        shards=shards,
+    )
+    with open(os.path.join(output_dir, "index.json"), "w") as f:
+        json.dump(index, f, indent=2)
+
+
+class ShardedImageLoader(IterableDataset):
+    """ Streaming dataset that reads image pairs sequentially from tar shards (see write_shards).
+        Drop-in replacement for ImageLoader: the elements are the same (transformed) samples.
+
+        With shuffle=True, the shard order is shuffled and the shards are distributed over the
+        dataloader workers, samples are additionally mixed with a shuffle buffer. Otherwise, all
+        samples are returned in manifest order: each worker reads only the byte ranges of every
+        num_workers-th batch, which matches the round-robin order in which the DataLoader
+        collects the batches of its workers.
+
+        In a distributed run (world_size > 1), the shards are distributed over the workers of all
+        processes instead. Every process gets the same number of samples per worker, such that all
+        processes run the same number of iterations; the surplus samples of a share are skipped.
+    """
+
+    def __init__(
+        self,
+        shard_dir,
+        mode,
+        shuffle=False,
+        seed=None,
+        transform=None,
+        dataset="kitti",
+        batch_size=1,
+        shuffle_buffer=256,
+        draft_size=None,
+        rank=0,
+        world_size=1,
+    ):
+        """
+        Args:
+            shard_dir: directory with the shards and their index.json
+            mode: 'train', 'val' or 'test'
+            shuffle: shuffle shards and samples
+            seed: (int) fixed seed for shuffling (same order in every epoch), None draws a new
+                  seed from torch's random number generator for every epoch
+            transform: a torchvision.transforms type transform
+            dataset: dataset name, e.g. "kitti" or "cityscapes"
+            batch_size: batch size of the DataLoader (needed to keep the order when not shuffling)
+            shuffle_buffer: number of samples that are mixed when shuffling
+            draft_size: (width, height) minimum size for reduced-resolution JPEG decoding
+            rank: rank of this process in a distributed run
+            world_size: number of processes of a distributed run
+        """
+        super(ShardedImageLoader, self).__init__()
+        index_path = os.path.join(shard_dir, "index.json")
+        if not os.path.exists(index_path):
+            raise FileNotFoundError(
+                f"No shards found in {shard_dir}, create them with helper-scripts/gen_shards.py"
+            )
+        with open(index_path) as f:
+            self.index = json.load(f)
+
+        if (mode == "train" or mode == "val") and not self.index["has_right"]:
+            raise ValueError(f"Shards in {shard_dir} contain no right images")
+
+        self.shard_dir = shard_dir
+        self.mode = mode
+        self.shuffle = shuffle
+        self.seed = seed
+        self.transform = transform
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle_buffer = shuffle_buffer
+        self.draft_size = draft_size
+        self.rank = rank
+        self.world_size = world_size
+
+        # Number of __iter__ calls, such that persistent workers get new orders as well
+        self._iteration = 0
+
+        # Set by the training loop, new shard orders in distributed runs (see set_epoch)
+        self.epoch = 0
+
+        # Sample offsets of shards written without them, by shard name (see _sample_offsets)
+        self._offsets = {}
+
+    def __len__(self):
+        """ Number of samples (per process in a distributed run, where the exact number depends on
+        the shard distribution). When shuffling with several workers, every worker ends with its own
+        partial batch, so the DataLoader yields more batches than its len() reports.
+        """
+        return self.index["num_images"] // self.world_size
+
+    def set_epoch(self, epoch):
+        """ Set the epoch before iterating over the loader. In a distributed run, the shard order
+        is derived from it (like DistributedSampler.set_epoch), because it has to be the same in
+        all processes. The workers receive a copy of the dataset when the loader is iterated, so
+        their own iteration counts do not advance between epochs (unless they are persistent).
+        """
+        self.epoch = epoch
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        if worker_info is None:
+            worker_id, num_workers = 0, 1
+            base_seed = int(torch.empty((), dtype=torch.int64).random_().item())
+        else:
+            worker_id, num_workers = worker_info.id, worker_info.num_workers
+            # Identical for all workers of one DataLoader iterator
+            base_seed = worker_info.seed - worker_info.id
+
+        shards = self.index["shards"]
+        if self.world_size > 1:
+            samples = self._distributed_samples(worker_id, num_workers)
+        elif self.shuffle:
+            seed = self.seed if self.seed is not None else base_seed + self._iteration
+            rng = random.Random(seed)
+            shards = list(shards)
+            rng.shuffle(shards)
+            shards = shards[worker_id::num_workers]
+            if len(self.index["shards"]) < num_workers:
+                logger.warning(
+                    f"Only {len(self.index['shards'])} shards for {num_workers} workers"
+                )
+            samples = self._shuffled(self._read(shards), rng)
+        else:
+            samples = self._read_batches(worker_id, num_workers)
+
+        self._iteration += 1
+
+        for left_bytes, right_bytes in samples:
+            yield self._decode(left_bytes, right_bytes)
+
+    def _distributed_samples(self, worker_id, num_workers):
+        """ Samples of a worker of this process in a distributed run """
+        shards = list(self.index["shards"])
+        rng = None
+        if self.shuffle:
+            # The shard order has to be the same in all processes, whose workers have different
+            # seeds. Persistent workers keep the epoch of their start but count their iterations
+            if self.seed is not None:
+                seed = self.seed
+            else:
+                seed = 9001 + self.epoch + self._iteration
+            rng = random.Random(seed)
+            rng.shuffle(shards)
+
+        n_shares = self.world_size * num_workers
+        if len(shards) < n_shares:
+            logger.warning(
+                f"Only {len(shards)} shards for {num_workers} workers in {self.world_size} processes"
+            )
+
+        def share(rank):
+            return shards[rank * num_workers + worker_id :: n_shares]
+
+        # Same number of samples for this worker in every process
+        n_samples = min(
+            sum(shard["num_images"] for shard in share(rank))
+            for rank in range(self.world_size)
+        )
+        samples = self._read(share(self.rank))
+        if rng is not None:
+            samples = self._shuffled(samples, rng)
+        return itertools.islice(samples, n_samples)
+
+    def _read(self, shards):
+        """ Read the encoded (left, right) image bytes sequentially from the shards """
+        for shard in shards:
+            path = os.path.join(self.shard_dir, shard["name"])
+            with tarfile.open(path, "r|") as tar:
+                yield from self._samples(tar)
+
+    def _read_batches(self, worker_id, num_workers):
+        """ Read the samples of every num_workers-th batch, starting with batch worker_id. Only the
+        byte ranges of these batches are read from the shards, such that the workers together read
+        every shard once.
+        """
+        n_img = self.index["num_images"]
+        batch_starts = range(
+            worker_id * self.batch_size, n_img, num_workers * self.batch_size
+        )
+        for start in batch_starts:
+            stop = min(start + self.batch_size, n_img)
+            # A batch can span several shards
+            for shard in self.index["shards"]:
+                first = max(start, shard["start"]) - shard["start"]
+                last = min(stop, shard["start"] + shard["num_images"]) - shard["start"]
+                if first < last:
+                    yield from self._read_range(shard, first, last)
+
+    def _read_range(self, shard, first, last):
+        """ Read the samples first, ..., last - 1 of a shard """
+        offsets = self._sample_offsets(shard)
+        with open(os.path.join(self.shard_dir, shard["name"]), "rb") as f:
+            f.seek(offsets[first])
+            data = f.read(offsets[last] - offsets[first])
+        with tarfile.open(fileobj=io.BytesIO(data), mode="r|") as tar:
+            yield from self._samples(tar)
+
+    def _sample_offsets(self, shard):
+        """ Byte offsets of the samples of a shard and the end of the last sample """
+        if "offsets" in shard:
+            return shard["offsets"]
+
+        # Shards written without offsets: read all member headers once (not the images)
+        if shard["name"] not in self._offsets:
+            n_views = 2 if self.index["has_right"] else 1
+            with tarfile.open(os.path.join(self.shard_dir, shard["name"])) as tar:
+                members = tar.getmembers()
+                end = tar.offset
+            offsets = [member.offset for member in members[::n_views]]
+            self._offsets[shard["name"]] = offsets + [end]
+        return self._offsets[shard["name"]]
+
+    def _samples(self, tar):
+        """ Encoded (left, right) image bytes of the samples in a tar stream """
+        n_views = 2 if self.index["has_right"] else 1
+        sample = {}
+        for member in tar:
+            view = member.name.split(".")[1]
+            sample[view] = tar.extractfile(member).read()
+
+            if len(sample) == n_views:
+                yield sample["left"], sample.get("right")
+                sample = {}
+
+    def _shuffled(self, samples, rng):
+        """ Mix a stream of samples with a shuffle buffer """
+        buffer = []
+        for sample in samples:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(sample)
+                continue
+            idx = rng.randrange(len(buffer))
+            yield buffer[idx]
+            buffer[idx] = sample
+        rng.shuffle(buffer)
+        for sample in buffer:
+            yield sample
+
+    def _decode(self, left_bytes, right_bytes):
+        left_image = open_image(io.BytesIO(left_bytes), self.dataset, self.draft_size)
+
+        if self.mode == "train" or self.mode == "val":
+            right_image = open_image(
+                io.BytesIO(right_bytes), self.dataset, self.draft_size
+            )
+            sample = {"left_image": left_image, "right_image": right_image}
+        else:
+            sample = left_image
+
+        if self.transform:
+            sample = self.transform(sample)
+        return sample
@@ -1,6 +1,8 @@
 import torch
+import torch.nn.functional as F
 import torchvision.transforms as transforms
 import numpy as np
+from PIL import Image
 
 
 def image_transforms(
@@ -9,6 +11,8 @@ def image_transforms(
     do_augmentation=True,
     transformations=None,
     size=(256, 512),
+    resize=True,
+    uint8=False,
 ):
     """
 
@@ -18,31 +22,46 @@ def image_transforms(
         do_augmentation: augmentation on or off
         transformations: torchvision.transform, only used if mode=="custom"
         size: image dimensions (nx, ny)
+        resize: resize the images to size (disable for images that already have this size,
+                e.g. when loading from a pre-decoded image cache)
+        uint8: ("train" and "val" only) emit uint8 tensors in HxWxC layout instead of float tensors,
+               the conversion is done batch-wise later on (see batch_to_float). Requires
+               do_augmentation=False, augmentation has to be applied batch-wise as well
 
     Returns:
         torchvision.transforms transform
     """
+    train = mode == "train" or mode == "val"
+    resize_transform = [ResizeImage(train=train, size=size)] if resize else []
+
+    if uint8:
+        if not train or do_augmentation:
+            raise ValueError(
+                "uint8 images are only supported for train and val without augmentation"
+            )
+        return transforms.Compose(resize_transform + [ToUint8Tensor(train=True)])
+
     if mode == "train":
-        data_transform = transforms.Compose(
-            [
-                ResizeImage(train=True, size=size),
-                RandomFlip(do_augmentation),
-                ToTensor(train=True),
-                AugmentImagePair(augment_parameters, do_augmentation),
-            ]
-        )
+        if do_augmentation:
+            data_transform = transforms.Compose(
+                resize_transform
+                + [
+                    RandomFlip(do_augmentation),
+                    ToTensor(train=True),
+                    AugmentImagePair(augment_parameters, do_augmentation),
+                ]
+            )
+        else:
+            data_transform = transforms.Compose(
+                resize_transform + [ToTensor(train=True)]
+            )
         return data_transform
     elif mode == "val":
-        data_transform = transforms.Compose(
-            [
-                ResizeImage(train=True, size=size),
-                ToTensor(train=True),
-            ]
-        )
+        data_transform = transforms.Compose(resize_transform + [ToTensor(train=True)])
         return data_transform
     elif mode == "test":
         data_transform = transforms.Compose(
-            [ResizeImage(train=False, size=size), ToTensor(train=False), DoTest()]
+            resize_transform + [ToTensor(train=False), DoTest()]
         )
         return data_transform
     elif mode == "custom":
@@ -56,6 +75,56 @@ def crop_cityscapes(img):
     return transforms.functional.crop(img, 0, 0, img.size[1]*0.8,img.size[0])
 
 
+def decode_draft_size(size, draft_decode="none"):
+    """ Minimum decoded image size for reduced-resolution JPEG decoding (see open_image)
+
+    Args:
+        size: (tuple) height and width the images are resized to
+        draft_decode: "none": always decode at full resolution
+                      "strict": decode at a reduced scale as long as width and height stay at least
+                                at the target size (the final resize only downsamples)
+                      "width": only keep the width at least at the target width, the height may be
+                               upsampled by the final resize (e.g. 1242x375 KITTI frames are decoded
+                               at 621x188 for 512x256 inputs)
+
+    Returns:
+        (width, height) or None
+    """
+    if draft_decode == "none":
+        return None
+    elif draft_decode == "strict":
+        return size[1], size[0]
+    elif draft_decode == "width":
+        return size[1], 1
+    else:
+        raise ValueError(f"Unknown draft decode mode: {draft_decode}")
+
+
+def open_image(fp, dataset="kitti", draft_size=None):
+    """ Open an image and apply dataset specific preprocessing (cropping for cityscapes)
+
+    Args:
+        fp: image path or file object
+        dataset: dataset name, e.g. "kitti" or "cityscapes"
+        draft_size: (width, height) or None. If set, JPEGs are decoded at the smallest DCT scale
+                    (1/2, 1/4 or 1/8) that is still at least this size (after cropping)
+
+    Returns:
+        PIL image
+    """
+    image = Image.open(fp)
+    if draft_size is not None:
+        width, height = draft_size
+        if dataset == "cityscapes":
+            # Cityscapes images are cropped to 80% of their height afterwards
+            height = int(np.ceil(height / 0.8))
+        # No-op for anything but JPEGs
+        image.draft(image.mode, (width, height))
+    if dataset == "cityscapes":
+        image = crop_cityscapes(image)
+    return image
+
+
 class ResizeImage(object):
     """ Apply torchvision.transforms.Resize() to image (when train=False) or dict of left and right image (train=True)
     """
@@ -108,21 +177,109 @@ class ToTensor(object):
         return sample
 
 
+class ToArray(object):
+    """ Convert a PIL image (when train=False) or dict of left and right image (train=True)
+        to uint8 numpy arrays in HxWxC layout
+    """
+
+    def __init__(self, train):
+        self.train = train
+
+    def transform(self, image):
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        return np.array(image, dtype=np.uint8)
+
+    def __call__(self, sample):
+        if self.train:
+            left_image = sample["left_image"]
+            right_image = sample["right_image"]
+            sample = {
+                "left_image": self.transform(left_image),
+                "right_image": self.transform(right_image),
+            }
+        else:
+            sample = self.transform(sample)
+        return sample
+
+
+class ToUint8Tensor(ToArray):
+    """ Convert a PIL image or uint8 HxWxC numpy array (when train=False) or dict of left and right
+        image (train=True) to uint8 tensors in HxWxC layout. Arrays are not copied.
+    """
+
+    def transform(self, image):
+        if not isinstance(image, np.ndarray):
+            image = super(ToUint8Tensor, self).transform(image)
+        return torch.from_numpy(image)
+
+
+class ScalePyramid(object):
+    """ Add the lower levels of the scale pyramid (see MonodepthLoss.scale_pyramid) of the left and
+        right image to a dict of float image tensors, as "left_pyramid" and "right_pyramid".
+        The i-th element is the image at (h // 2**(i+1), w // 2**(i+1)).
+    """
+
+    def __init__(self, num_scales=4):
+        self.num_scales = num_scales
+
+    def pyramid(self, image):
+        _, h, w = image.size()
+        return [
+            F.interpolate(
+                image.unsqueeze(0), size=[h // 2 ** i, w // 2 ** i], mode="area"
+            ).squeeze(0)
+            for i in range(1, self.num_scales)
+        ]
+
+    def __call__(self, sample):
+        return dict(
+            sample,
+            left_pyramid=self.pyramid(sample["left_image"]),
+            right_pyramid=self.pyramid(sample["right_image"]),
+        )
+
+
+def batch_to_float(sample):
+    """ Convert the batched uint8 images (n_batch, h, w, 3) of a sample (see ToUint8Tensor) to float
+        tensors (n_batch, 3, h, w) in [0, 1], i.e. the same as ToTensor. Works on any device.
+
+    Args:
+        sample: dict with left_image and right_image
+
+    Returns:
+        dict with the converted images
+    """
+    return dict(
+        sample,
+        **{
+            key: sample[key].permute(0, 3, 1, 2).contiguous().float().div_(255)
+            for key in ("left_image", "right_image")
+        },
+    )
+
+
 class RandomFlip(object):
-    """ Randomly flip an image pair
+    """ Randomly flip an image pair (PIL images or HxWxC numpy arrays)
     """
     def __init__(self, do_augmentation):
         self.transform = transforms.RandomHorizontalFlip(p=1)
         self.do_augmentation = do_augmentation
 
+    def flip(self, image):
+        if isinstance(image, np.ndarray):
+            # Copy, since torch.from_numpy does not support negative strides
+            return np.ascontiguousarray(image[:, ::-1])
+        return self.transform(image)
+
     def __call__(self, sample):
         left_image = sample["left_image"]
         right_image = sample["right_image"]
         k = np.random.uniform(0, 1, 1)
         if self.do_augmentation:
             if k > 0.5:
-                fliped_left = self.transform(right_image)
-                fliped_right = self.transform(left_image)
+                fliped_left = self.flip(right_image)
+                fliped_right = self.flip(left_image)
                 sample = {"left_image": fliped_left, "right_image": fliped_right}
         else:
             sample = {"left_image": left_image, "right_image": right_image}
@@ -183,3 +340,67 @@ class AugmentImagePair(object):
         return sample
 
 
+class AugmentImageBatch(object):
+    """ Batched version of RandomFlip followed by AugmentImagePair. Works on collated batches
+        of left and right images (n_batch, 3, h, w) on any device, e.g. after the batch has been
+        moved to the training device. The random parameters are drawn per sample as tensors and
+        all samples are augmented at once.
+    """
+
+    def __init__(self, augment_parameters, do_augmentation):
+        """
+
+        Args:
+            augment_parameters: list [gamma_low, gamma_high, brightness_low, brightness_high, color_low, color_high]
+            do_augmentation: boolean, decides wether any augmentation is done
+        """
+        self.do_augmentation = do_augmentation
+        self.gamma_low = augment_parameters[0]  # 0.8
+        self.gamma_high = augment_parameters[1]  # 1.2
+        self.brightness_low = augment_parameters[2]  # 0.5
+        self.brightness_high = augment_parameters[3]  # 2.0
+        self.color_low = augment_parameters[4]  # 0.8
+        self.color_high = augment_parameters[5]  # 1.2
+
+    def __call__(self, sample):
+        if not self.do_augmentation:
+            return sample
+
+        left_image = sample["left_image"]
+        right_image = sample["right_image"]
+        n = left_image.size(0)
+
+        def uniform(low, high, n_channels=1):
+            return torch.empty(
+                n, n_channels, 1, 1, dtype=left_image.dtype, device=left_image.device
+            ).uniform_(low, high)
+
+        # randomly flip: the flipped left image is the mirrored right image and vice versa
+        flip = uniform(0, 1) > 0.5
+        left_image, right_image = (
+            torch.where(flip, torch.flip(right_image, [3]), left_image),
+            torch.where(flip, torch.flip(left_image, [3]), right_image),
+        )
+
+        # samples that are not augmented get the identity parameters
+        augment = uniform(0, 1) > 0.5
+        one = torch.ones_like(augment, dtype=left_image.dtype)
+
+        # randomly shift gamma, brightness and color
+        random_gamma = torch.where(
+            augment, uniform(self.gamma_low, self.gamma_high), one
+        )
+        random_brightness = torch.where(
+            augment, uniform(self.brightness_low, self.brightness_high), one
+        )
+        random_colors = torch.where(
+            augment, uniform(self.color_low, self.color_high, 3), one
+        )
+        scale = random_brightness * random_colors
+
+        # saturate
+        left_image = torch.clamp(left_image ** random_gamma * scale, 0, 1)
+        right_image = torch.clamp(right_image ** random_gamma * scale, 0, 1)
+
+        sample = dict(sample, left_image=left_image, right_image=right_image)
+        return sample
@@ -1,6 +1,48 @@
+import functools
+from collections import OrderedDict
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.hooks import RemovableHandle
+
+# Base sampling grids that have already been created, by (height, width, dtype, device)
+_base_grids = {}
+
+
+def base_grid(height, width, dtype=torch.float32, device="cpu"):
+    """ Get the original pixel coordinates of an image in [0, 1] (see apply_disparity).
+        The grids are created once per size, dtype and device and broadcast over the batch.
+
+    Args:
+        height: image height
+        width: image width
+        dtype: torch dtype of the image
+        device: device of the image
+
+    Returns:
+        x_base, y_base: (1, height, width) x and y coordinates
+    """
+    key = (height, width, dtype, torch.device(device))
+    if key not in _base_grids:
+        x_base = torch.linspace(0, 1, width, dtype=dtype, device=device)
+        y_base = torch.linspace(0, 1, height, dtype=dtype, device=device)
+        _base_grids[key] = (
+            x_base.view(1, 1, width).expand(1, height, width),
+            y_base.view(1, height, 1).expand(1, height, width),
+        )
+    return _base_grids[key]
+
+
+def float32(method):
+    """ Run a loss method in float32 with autocast disabled (for numerically sensitive parts) """
+
+    @functools.wraps(method)
+    def wrapper(self, *tensors):
+        with torch.autocast(tensors[0].device.type, enabled=False):
+            return method(self, *(t.float() for t in tensors))
+
+    return wrapper
 
 
 class MonodepthLoss(nn.modules.Module):
@@ -11,6 +53,24 @@ class MonodepthLoss(nn.modules.Module):
         self.disp_gradient_w = disp_gradient_w
         self.lr_w = lr_w
         self.n = None
+        self._debug_hooks = OrderedDict()
+
+    def register_debug_hook(self, hook):
+        """ Register a hook that receives the intermediate results of every forward pass, e.g. for
+            visualizations. The intermediate results are not kept on the module, such that the
+            reconstructed images and their graph can be freed after each step.
+
+        Args:
+            hook: callable hook(module, intermediates), intermediates is a dict with the lists
+                  disp_left_est, disp_right_est, left_est and right_est (one tensor per scale) and
+                  the scalars image_loss, disp_gradient_loss and lr_loss
+
+        Returns:
+            handle to remove the hook with handle.remove()
+        """
+        handle = RemovableHandle(self._debug_hooks)
+        self._debug_hooks[handle.id] = hook
+        return handle
 
     def scale_pyramid(self, img, num_scales):
         """ Compute a pyramid of an image at different scales.
@@ -64,6 +124,7 @@ class MonodepthLoss(nn.modules.Module):
         gy = img[:, :, :-1, :] - img[:, :, 1:, :]  # NCHW
         return gy
 
+    @float32
     def apply_disparity(self, img, disp):
         """ Applies a disparity map to an image.
 
@@ -77,22 +138,13 @@ class MonodepthLoss(nn.modules.Module):
         batch_size, _, height, width = img.size()
 
         # Original coordinates of pixels
-        x_base = (
-            torch.linspace(0, 1, width)
-            .repeat(batch_size, height, 1)
-            .type_as(img)
-            .to(self.device)
-        )
-        y_base = (
-            torch.linspace(0, 1, height)
-            .repeat(batch_size, width, 1)
-            .transpose(1, 2)
-            .type_as(img)
-        ).to(self.device)
+        x_base, y_base = base_grid(height, width, img.dtype, img.device)
 
         # Apply shift in X direction
         x_shifts = disp[:, 0, :, :]  # Disparity is passed in NCHW format with 1 channel
-        flow_field = torch.stack((x_base + x_shifts, y_base), dim=3)
+        flow_field = torch.stack(
+            (x_base + x_shifts, y_base.expand(batch_size, height, width)), dim=3
+        )
         # In grid_sample coordinates are assumed to be between -1 and 1
         output = F.grid_sample(
             img, 2 * flow_field - 1, mode="bilinear", padding_mode="zeros"
@@ -124,6 +176,7 @@ class MonodepthLoss(nn.modules.Module):
         """
         return self.apply_disparity(img, disp)
 
+    @float32
     def SSIM(self, x, y):
         """ Compute the structural similarity index between two images
 
@@ -137,15 +190,17 @@ class MonodepthLoss(nn.modules.Module):
         C1 = 0.01 ** 2
         C2 = 0.03 ** 2
 
-        mu_x = nn.AvgPool2d(3, 1)(x)
-        mu_y = nn.AvgPool2d(3, 1)(y)
+        # Pool the means of x, y, x^2, y^2 and xy in a single pass
+        pooled = F.avg_pool2d(torch.cat((x, y, x * x, y * y, x * y)), 3, 1)
+        mu_x, mu_y, mu_xx, mu_yy, mu_xy = pooled.chunk(5)
+
         mu_x_mu_y = mu_x * mu_y
         mu_x_sq = mu_x.pow(2)
         mu_y_sq = mu_y.pow(2)
 
-        sigma_x = nn.AvgPool2d(3, 1)(x * x) - mu_x_sq
-        sigma_y = nn.AvgPool2d(3, 1)(y * y) - mu_y_sq
-        sigma_xy = nn.AvgPool2d(3, 1)(x * y) - mu_x_mu_y
+        sigma_x = mu_xx - mu_x_sq
+        sigma_y = mu_yy - mu_y_sq
+        sigma_xy = mu_xy - mu_x_mu_y
 
         SSIM_n = (2 * mu_x_mu_y + C1) * (2 * sigma_xy + C2)
         SSIM_d = (mu_x_sq + mu_y_sq + C1) * (sigma_x + sigma_y + C2)
@@ -185,12 +240,14 @@ class MonodepthLoss(nn.modules.Module):
         return smoothness_x + smoothness_y
 
 
-    def forward(self, input, target):
+    def forward(self, input, target, pyramids=None):
         """ Compute the loss, given disparity maps at 4 scales and left and right input images
 
         Args:
             input: [disp1, disp2, disp3, disp4], each (n_batch, 1, nx, ny)
             target: [left, right], each (n_batch, 3, nx, ny)
+            pyramids: optional precomputed [left_pyramid, right_pyramid] without the original scale,
+                      i.e. [img2, img3, img4] each (see scale_pyramid)
 
         Return:
             (float): The loss
@@ -202,99 +259,80 @@ class MonodepthLoss(nn.modules.Module):
         self.n = len(input)
 
         left, right = target
-        left_pyramid = self.scale_pyramid(left, self.n)
-        right_pyramid = self.scale_pyramid(right, self.n)
+        if pyramids is not None:
+            left_pyramid = [left] + list(pyramids[0][: self.n - 1])
+            right_pyramid = [right] + list(pyramids[1][: self.n - 1])
+        else:
+            left_pyramid = self.scale_pyramid(left, self.n)
+            right_pyramid = self.scale_pyramid(right, self.n)
 
         # Prepare disparities
         disp_left_est = [d[:, 0, :, :].unsqueeze(1) for d in input]
         disp_right_est = [d[:, 1, :, :].unsqueeze(1) for d in input]
 
-        self.disp_left_est = disp_left_est
-        self.disp_right_est = disp_right_est
-
-        # Generate images by applying the left disparity map to the right image and vice versa (at each pyramid scale)
-        left_est = [
-            self.generate_image_left(right_pyramid[i], disp_left_est[i])
-            for i in range(self.n)
+        # Both views are processed at once: left in the first, right in the second half of the batch.
+        # The means over the whole batch are the averages of the left and right means, hence all
+        # terms below are scaled by 2 to get the sums of the left and right terms.
+        batch_size = left.size(0)
+        pyramid = [
+            torch.cat((left_pyramid[i], right_pyramid[i])) for i in range(self.n)
+        ]
+        disp_est = [
+            torch.cat((disp_left_est[i], disp_right_est[i])) for i in range(self.n)
         ]
-        right_est = [
-            self.generate_image_right(left_pyramid[i], disp_right_est[i])
+
+        # Generate images by applying the left disparity map to the right image and vice versa
+        # (at each pyramid scale). The disparity maps are shifted along with the images (for the
+        # L-R consistency), i.e. one warp per scale: the right image and disparity map are shifted
+        # by the left disparity map, the left ones by the right disparity map.
+        warped = [
+            self.apply_disparity(
+                torch.cat(
+                    (
+                        torch.cat((right_pyramid[i], disp_right_est[i]), 1),
+                        torch.cat((left_pyramid[i], disp_left_est[i]), 1),
+                    )
+                ),
+                torch.cat((-disp_left_est[i], disp_right_est[i])),
+            )
             for i in range(self.n)
         ]
-        self.left_est = left_est
-        self.right_est = right_est
+        image_est = [w[:, :-1] for w in warped]
+        shifted_disp = [w[:, -1:] for w in warped]
 
         ###################
         # L-R Consistency #
         ###################
-        # Shift the right disparity map by the left disparity map and vice versa
-        right_left_disp = [
-            self.generate_image_left(disp_right_est[i], disp_left_est[i])
-            for i in range(self.n)
-        ]
-        left_right_disp = [
-            self.generate_image_right(disp_left_est[i], disp_right_est[i])
-            for i in range(self.n)
-        ]
-
         # Compute the difference between the estimated disparity map and the shifted ones
-        lr_left_loss = [
-            torch.mean(torch.abs(right_left_disp[i] - disp_left_est[i]))
-            for i in range(self.n)
-        ]
-        lr_right_loss = [
-            torch.mean(torch.abs(left_right_disp[i] - disp_right_est[i]))
+        lr_loss = sum(
+            2 * torch.mean(torch.abs(shifted_disp[i] - disp_est[i]))
             for i in range(self.n)
-        ]
-        lr_loss = sum(lr_left_loss + lr_right_loss)
+        )
 
         ##############
         # Smoothness #
         ##############
-        disp_left_smoothness = self.disp_smoothness(disp_left_est, left_pyramid)
-        disp_right_smoothness = self.disp_smoothness(disp_right_est, right_pyramid)
+        # Only the first n terms (x direction) enter the loss
+        disp_smoothness = self.disp_smoothness(disp_est, pyramid)
 
         # Weight the smoothness terms at different scales by 1 / 2**i
-        disp_left_loss = [
-            torch.mean(torch.abs(disp_left_smoothness[i])) / 2 ** i
-            for i in range(self.n)
-        ]
-        disp_right_loss = [
-            torch.mean(torch.abs(disp_right_smoothness[i])) / 2 ** i
+        disp_gradient_loss = sum(
+            2 * torch.mean(torch.abs(disp_smoothness[i])) / 2 ** i
             for i in range(self.n)
-        ]
-        disp_gradient_loss = sum(disp_left_loss + disp_right_loss)
+        )
 
         ########################
         # Image Reconstruction #
         ########################
         # consists of L1 norm and SSIM between estimated and input images
-        # L1
-        l1_left = [
-            torch.mean(torch.abs(left_est[i] - left_pyramid[i])) for i in range(self.n)
-        ]
-        l1_right = [
-            torch.mean(torch.abs(right_est[i] - right_pyramid[i]))
-            for i in range(self.n)
-        ]
-
-        # SSIM
-        ssim_left = [
-            torch.mean(self.SSIM(left_est[i], left_pyramid[i])) for i in range(self.n)
-        ]
-        ssim_right = [
-            torch.mean(self.SSIM(right_est[i], right_pyramid[i])) for i in range(self.n)
-        ]
-
-        image_loss_left = [
-            self.SSIM_w * ssim_left[i] + (1 - self.SSIM_w) * l1_left[i]
-            for i in range(self.n)
-        ]
-        image_loss_right = [
-            self.SSIM_w * ssim_right[i] + (1 - self.SSIM_w) * l1_right[i]
+        image_loss = sum(
+            2
+            * (
+                self.SSIM_w * torch.mean(self.SSIM(image_est[i], pyramid[i]))
+                + (1 - self.SSIM_w) * torch.mean(torch.abs(image_est[i] - pyramid[i]))
+            )
             for i in range(self.n)
-        ]
-        image_loss = sum(image_loss_left + image_loss_right)
+        )
 
         ##############
         # Total loss #
@@ -302,7 +340,18 @@ class MonodepthLoss(nn.modules.Module):
         loss = (
             image_loss + self.disp_gradient_w * disp_gradient_loss + self.lr_w * lr_loss
         )
-        self.image_loss = image_loss
-        self.disp_gradient_loss = disp_gradient_loss
-        self.lr_loss = lr_loss
+
+        if self._debug_hooks:
+            intermediates = dict(
+                disp_left_est=disp_left_est,
+                disp_right_est=disp_right_est,
+                left_est=[est[:batch_size] for est in image_est],
+                right_est=[est[batch_size:] for est in image_est],
+                image_loss=image_loss,
+                disp_gradient_loss=disp_gradient_loss,
+                lr_loss=lr_loss,
+            )
+            for hook in self._debug_hooks.values():
+                hook(self, intermediates)
+
         return loss, image_loss, disp_gradient_loss, lr_loss
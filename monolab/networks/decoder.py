@@ -19,6 +19,22 @@ def get_strides(output_stride):
     return strides
 
 
+def iconv_concat(layer, inputs, concat_free=False):
+    """ Apply an iconv layer to the concatenation of inputs
+
+    Args:
+        layer: conv layer
+        inputs: list of tensors, concatenated along the channels
+        concat_free: split the layer's weight instead of concatenating the inputs (see conv.forward_concat)
+
+    Returns:
+        output of the layer
+    """
+    if concat_free:
+        return layer.forward_concat(inputs)
+    return layer(torch.cat(inputs, 1))
+
+
 class MonodepthDecoder(nn.Module):
     def __init__(
         self,
@@ -108,6 +124,9 @@ class MonodepthDecoder(nn.Module):
 
         self.upsample_nn = upsample_nn(scale=2)
 
+        # Skip the concatenations of the iconv inputs (same weights and results)
+        self.concat_free = False
+
         for m in self.modules():
             if isinstance(m, nn.Conv2d):
                 nn.init.xavier_uniform_(m.weight)
@@ -122,16 +141,13 @@ class MonodepthDecoder(nn.Module):
 
         # decoder
         upconv6 = self.upconv6(x_enc)
-        concat6 = torch.cat([upconv6, skip5], 1)
-        iconv6 = self.iconv6(concat6)
+        iconv6 = iconv_concat(self.iconv6, [upconv6, skip5], self.concat_free)
 
         upconv5 = self.upconv5(iconv6)
-        concat5 = torch.cat([upconv5, skip4], 1)
-        iconv5 = self.iconv5(concat5)
+        iconv5 = iconv_concat(self.iconv5, [upconv5, skip4], self.concat_free)
 
         upconv4 = self.upconv4(iconv5)
-        concat4 = torch.cat([upconv4, skip3], 1)
-        iconv4 = self.iconv4(concat4)
+        iconv4 = iconv_concat(self.iconv4, [upconv4, skip3], self.concat_free)
         disp4 = self.disp4(iconv4)
         udisp4 = self.udisp4(disp4)
 
@@ -139,20 +155,17 @@ class MonodepthDecoder(nn.Module):
             disp4 = nn.functional.interpolate(disp4, scale_factor=0.5, mode="nearest")
 
         upconv3 = self.upconv3(iconv4)
-        concat3 = torch.cat([upconv3, skip2, udisp4], 1)
-        iconv3 = self.iconv3(concat3)
+        iconv3 = iconv_concat(self.iconv3, [upconv3, skip2, udisp4], self.concat_free)
         disp3 = self.disp3(iconv3)
         udisp3 = self.upsample_nn(disp3)
 
         upconv2 = self.upconv2(iconv3)
-        concat2 = torch.cat([upconv2, skip1, udisp3], 1)
-        iconv2 = self.iconv2(concat2)
+        iconv2 = iconv_concat(self.iconv2, [upconv2, skip1, udisp3], self.concat_free)
         disp2 = self.disp2(iconv2)
         udisp2 = self.upsample_nn(disp2)
 
         upconv1 = self.upconv1(iconv2)
-        concat1 = torch.cat([upconv1, udisp2], 1)
-        iconv1 = self.iconv1(concat1)
+        iconv1 = iconv_concat(self.iconv1, [upconv1, udisp2], self.concat_free)
         disp1 = self.disp1(iconv1)
 
         return [disp1, disp2, disp3, disp4]
@@ -232,6 +245,9 @@ class MonodepthDecoderSkipless(nn.Module):
 
         self.upsample_nn = upsample_nn(scale=2)
 
+        # Skip the concatenations of the iconv inputs (same weights and results)
+        self.concat_free = False
+
         for m in self.modules():
             if isinstance(m, nn.Conv2d):
                 nn.init.xavier_uniform_(m.weight)
@@ -239,16 +255,13 @@ class MonodepthDecoderSkipless(nn.Module):
     def forward(self, x1, x_pool1, x2, x3, x4, x_enc):
         # decoder
         upconv6 = self.upconv6(x_enc)
-        concat6 = torch.cat([upconv6], 1)
-        iconv6 = self.iconv6(concat6)
+        iconv6 = self.iconv6(upconv6)
 
         upconv5 = self.upconv5(iconv6)
-        concat5 = torch.cat([upconv5], 1)
-        iconv5 = self.iconv5(concat5)
+        iconv5 = self.iconv5(upconv5)
 
         upconv4 = self.upconv4(iconv5)
-        concat4 = torch.cat([upconv4], 1)
-        iconv4 = self.iconv4(concat4)
+        iconv4 = self.iconv4(upconv4)
         disp4 = self.disp4(iconv4)
         udisp4 = self.udisp4(disp4)
 
@@ -256,20 +269,17 @@ class MonodepthDecoderSkipless(nn.Module):
             disp4 = nn.functional.interpolate(disp4, scale_factor=0.5, mode="nearest")
 
         upconv3 = self.upconv3(iconv4)
-        concat3 = torch.cat([upconv3, udisp4], 1)
-        iconv3 = self.iconv3(concat3)
+        iconv3 = iconv_concat(self.iconv3, [upconv3, udisp4], self.concat_free)
         disp3 = self.disp3(iconv3)
         udisp3 = self.upsample_nn(disp3)
 
         upconv2 = self.upconv2(iconv3)
-        concat2 = torch.cat([upconv2, udisp3], 1)
-        iconv2 = self.iconv2(concat2)
+        iconv2 = iconv_concat(self.iconv2, [upconv2, udisp3], self.concat_free)
         disp2 = self.disp2(iconv2)
         udisp2 = self.upsample_nn(disp2)
 
         upconv1 = self.upconv1(iconv2)
-        concat1 = torch.cat([upconv1, udisp2], 1)
-        iconv1 = self.iconv1(concat1)
+        iconv1 = iconv_concat(self.iconv1, [upconv1, udisp2], self.concat_free)
         disp1 = self.disp1(iconv1)
 
         return [disp1, disp2, disp3, disp4]
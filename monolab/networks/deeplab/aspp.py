@@ -120,10 +120,18 @@ class ASPP(nn.Module):
         self.relu = nn.ReLU()
         self._init_weight()
 
+        # Project the branch results without concatenating them (see _split_projection)
+        self.split_projection = False
+
     def forward(self, x):
         # Collect results from ASPP modules
         aspp_results = [l(x) for l in self.aspp_modules]
 
+        if self.split_projection:
+            x = self._split_projection(x, aspp_results)
+            x = self.bn1(x)
+            return self.relu(x)
+
         # Apply global average pooling if enabled
         if self.use_global_average_pooling:
             x_gl_avg_pool = self.global_avg_pool(x)
@@ -144,6 +152,29 @@ class ASPP(nn.Module):
 
         return x
 
+    def _split_projection(self, x, aspp_results):
+        """
+        Apply conv1 to the concatenation of the branch results without building it: the 1x1 conv
+        is the sum of the convs of each branch with its slice of the weight. The global average
+        pooling branch is constant over the image, its contribution is computed at 1x1 and broadcast
+        instead of being upsampled first. Uses the same weights as the concatenating forward pass.
+        Args:
+            x: ASPP input
+            aspp_results: results of the ASPP modules
+
+        Returns:
+            conv1 output
+        """
+        weights = self.conv1.weight.split(256, dim=1)
+
+        out = F.conv2d(aspp_results[0], weights[0])
+        for weight, branch in zip(weights[1:], aspp_results[1:]):
+            out = out.add_(F.conv2d(branch, weight))
+
+        if self.use_global_average_pooling:
+            out = out + F.conv2d(self.global_avg_pool(x), weights[-1])
+        return out
+
     def _init_weight(self):
         for m in self.modules():
             if isinstance(m, nn.Conv2d):
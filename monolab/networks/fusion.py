@@ -0,0 +1,75 @@
+import copy
+import logging
+
+from torch import nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+from monolab.networks.resnet import conv, resconv
+from monolab.networks.deeplab.aspp import ASPPModule, ASPP
+from monolab.networks.deeplab.deeplab_decoder import SkipConnection
+from monolab.networks import dummy_model
+
+logger = logging.getLogger(__name__)
+
+# (conv, batchnorm) attribute pairs of modules that apply the batchnorm directly after the conv
+# outside of an nn.Sequential
+_CONV_BN_ATTRIBUTES = {
+    ASPPModule: [("atrous_conv", "bn")],
+    ASPP: [("conv1", "bn1")],
+    SkipConnection: [("conv1", "bn1")],
+    dummy_model.get_disp: [("conv1", "normalize")],
+}
+
+
+def fuse_model(model: nn.Module, inplace=False) -> nn.Module:
+    """ Prepare a model for inference: fold every BatchNorm into the preceding convolution
+    and let the activations that directly follow a convolution work in-place.
+    The fused model computes the same outputs in eval mode (up to float rounding) but
+    cannot be trained anymore.
+
+    Args:
+        model: model as returned by utils.get_model (also wrapped in nn.DataParallel)
+        inplace: fuse the given model instead of a copy
+
+    Returns:
+        fused model in eval mode
+    """
+    if not inplace:
+        model = copy.deepcopy(model)
+    model.eval()
+
+    n_folded = 0
+    for module in model.modules():
+        # Conv2d > BatchNorm2d in sequential blocks (deeplab decoder, vgg, aspp pooling)
+        if isinstance(module, nn.Sequential):
+            names = list(module._modules.keys())
+            for conv_name, bn_name in zip(names[:-1], names[1:]):
+                n_folded += _fold(module, conv_name, bn_name)
+
+        for conv_name, bn_name in _CONV_BN_ATTRIBUTES.get(type(module), []):
+            n_folded += _fold(module, conv_name, bn_name)
+
+        # Activations on freshly computed conv outputs
+        if isinstance(module, (conv, resconv)):
+            module.inplace = True
+        elif isinstance(module, (nn.ReLU, nn.ELU)):
+            module.inplace = True
+
+    logger.info(f"Folded {n_folded} batchnorm layers into convolutions")
+    return model
+
+
+def _fold(module, conv_name, bn_name):
+    """ Fold module.<bn_name> into module.<conv_name> and replace the batchnorm by an identity """
+    conv_layer = getattr(module, conv_name)
+    bn = getattr(module, bn_name)
+    if not (
+        isinstance(conv_layer, nn.Conv2d)
+        and isinstance(bn, nn.BatchNorm2d)
+        and bn.track_running_stats
+    ):
+        return 0
+
+    setattr(module, conv_name, fuse_conv_bn_eval(conv_layer, bn))
+    setattr(module, bn_name, nn.Identity())
+    return 1
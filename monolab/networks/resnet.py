@@ -1,6 +1,7 @@
 import torch.nn as nn
 import torch.nn.functional as F
 import torch
+from torch.utils.checkpoint import checkpoint
 
 import numpy as np
 
@@ -85,9 +86,35 @@ class conv(nn.Module):
             dilation=dilation,
         )
 
+        # Apply the activation in-place (inference only, see networks.fusion)
+        self.inplace = False
+
     def forward(self, x):
         x = self.conv(x)
-        return F.elu(x)
+        return F.elu(x, inplace=self.inplace)
+
+    def forward_concat(self, xs):
+        """ Same as forward(torch.cat(xs, 1)), but without building the concatenation:
+            the convolution is the sum of the convolutions of the inputs with their slices
+            of the weight
+
+        Args:
+            xs: list of inputs with the same spatial size
+
+        Returns:
+            output of the layer
+        """
+        weights = self.conv.weight.split([x.size(1) for x in xs], dim=1)
+        kwargs = dict(
+            stride=self.conv.stride,
+            padding=self.conv.padding,
+            dilation=self.conv.dilation,
+        )
+
+        out = F.conv2d(xs[0], weights[0], self.conv.bias, **kwargs)
+        for weight, x in zip(weights[1:], xs[1:]):
+            out = out.add_(F.conv2d(x, weight, **kwargs))
+        return F.elu(out, inplace=self.inplace)
 
 
 class upconv(nn.Module):
@@ -138,24 +165,37 @@ class resconv(nn.Module):
         )
         self.conv3 = nn.Conv2d(num_layers, 4 * num_layers, kernel_size=1, stride=1)
 
-        self.shortcut_conv = nn.Conv2d(
-            n_in, 4 * num_layers, kernel_size=1, stride=stride
-        )
+        # Project the shortcut only when the shape changes, so that every parameter
+        # receives a gradient (required by DistributedDataParallel)
+        self.do_proj = n_in != 4 * num_layers or stride == 2
+        if self.do_proj:
+            self.shortcut_conv = nn.Conv2d(
+                n_in, 4 * num_layers, kernel_size=1, stride=stride
+            )
+
+        # Apply the activation in-place (inference only, see networks.fusion)
+        self.inplace = False
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Checkpoints written before the unused shortcut projections were removed
+        if not self.do_proj:
+            for name in ["weight", "bias"]:
+                state_dict.pop(prefix + "shortcut_conv." + name, None)
+        super(resconv, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def forward(self, x):
-        do_proj = x.shape[1] != 4 * self.num_layers or self.stride == 2
         shortcut = []
 
         conv1 = self.conv1(x)
         conv2 = self.conv2(conv1)
         conv3 = self.conv3(conv2)
 
-        if do_proj:
+        if self.do_proj:
             shortcut = self.shortcut_conv(x)
         else:
             shortcut = x
 
-        return F.elu(conv3 + shortcut)
+        return F.elu(conv3 + shortcut, inplace=self.inplace)
 
 
 class resblock(nn.Module):
@@ -189,8 +229,17 @@ class resblock(nn.Module):
         )
         self.block = nn.Sequential(*layers)
 
+        # Recompute the activations inside the resconv units in the backward pass
+        self.checkpoint = False
+
     def forward(self, x):
-        return self.block(x)
+        if not (self.checkpoint and torch.is_grad_enabled()):
+            return self.block(x)
+
+        # Only the outputs of the units are kept for the backward pass
+        for unit in self.block:
+            x = checkpoint(unit, x, use_reentrant=False)
+        return x
 
 
 class Resnet(nn.Module):
@@ -256,6 +305,16 @@ class Resnet(nn.Module):
             if isinstance(m, nn.Conv2d):
                 nn.init.xavier_uniform_(m.weight)
 
+    def set_checkpointing(self, resblocks):
+        """ Enable gradient checkpointing for resblocks, which trades memory for an additional
+            forward pass through these blocks during the backward pass
+
+        Args:
+            resblocks: list of resblock numbers (2 to 5 for conv2 to conv5)
+        """
+        for i in range(2, 6):
+            getattr(self, f"conv{i}").checkpoint = i in resblocks
+
     def forward(self, x):
         # encoder
         x1 = self.conv1(x)
@@ -0,0 +1,117 @@
+""" Standalone inference with a model exported by export.py. Only needs torch, numpy and PIL,
+the monolab package is not imported.
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Run an exported Monolab model on images"
+    )
+    parser.add_argument(
+        "--artifact", default="model.pt", help="TorchScript module written by export.py"
+    )
+    parser.add_argument("--images", nargs="+", help="Input images", metavar="FILE")
+    parser.add_argument(
+        "--output",
+        default="disparities.npy",
+        help="Output file for the disparity maps (n_images, height, width)",
+        metavar="FILE",
+    )
+    parser.add_argument(
+        "--post-process",
+        default=False,
+        action="store_true",
+        help="Combine the disparities of each image and its mirrored version as in test.py \
+                        (requires a module exported with batch size 2)",
+    )
+    parser.add_argument("--num-threads", type=int, default=None, help="CPU threads")
+    args = parser.parse_args()
+    return args
+
+
+def load_artifact(path, optimize=True):
+    """ Load an exported model and its metadata
+
+    Args:
+        path: path to the TorchScript module
+        optimize: apply the inference optimizations for the current CPU (e.g. prepacked
+                  convolutions), which cannot be stored in the artifact
+
+    Returns:
+        module, metadata dict
+    """
+    extra_files = {"metadata.json": ""}
+    module = torch.jit.load(path, map_location="cpu", _extra_files=extra_files)
+    if optimize:
+        module = torch.jit.optimize_for_inference(module)
+    return module, json.loads(extra_files["metadata.json"])
+
+
+def load_image(path, height, width):
+    """ Load an image as float tensor (3, height, width) in [0, 1], resized like in training """
+    image = Image.open(path).convert("RGB").resize((width, height), Image.BILINEAR)
+    return torch.from_numpy(np.array(image)).permute(2, 0, 1).float().div(255)
+
+
+def post_process_disparity(disp):
+    """ Apply the post-processing step described in the paper (same as test.py)
+
+    Args:
+        disp: [2, h, w] array, disparity maps of an image and of its mirrored version
+
+    Returns:
+        post-processed disparity map
+    """
+    (_, h, w) = disp.shape
+    l_disp = disp[0, :, :]
+    r_disp = np.fliplr(disp[1, :, :])
+    m_disp = 0.5 * (l_disp + r_disp)
+    (l, _) = np.meshgrid(np.linspace(0, 1, w), np.linspace(0, 1, h))
+    l_mask = 1.0 - np.clip(20 * (l - 0.05), 0, 1)
+    r_mask = np.fliplr(l_mask)
+    return r_mask * l_disp + l_mask * r_disp + (1.0 - l_mask - r_mask) * m_disp
+
+
+def main():
+    args = parse_args()
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
+
+    module, metadata = load_artifact(args.artifact)
+    batch_size, _, height, width = metadata["input_shape"]
+    print(f"Loaded {metadata['model']} for inputs of shape {metadata['input_shape']}")
+
+    if args.post_process and batch_size != 2:
+        raise ValueError("Post-processing needs a module exported with batch size 2")
+
+    # Every image is one batch: [image, mirrored image] for post-processing, else the
+    # image repeated to the fixed batch size
+    disparities = np.zeros((len(args.images), height, width), dtype=np.float32)
+    start = time.time()
+    with torch.no_grad():
+        for i, path in enumerate(args.images):
+            image = load_image(path, height, width)
+            if args.post_process:
+                batch = torch.stack((image, torch.flip(image, [2])))
+            else:
+                batch = image.unsqueeze(0).expand(batch_size, -1, -1, -1)
+
+            disp = module(batch)[0][:, 0].numpy()
+            disparities[i] = (
+                post_process_disparity(disp) if args.post_process else disp[0]
+            )
+
+    print(f"{(time.time() - start) / len(args.images) * 1000:.0f} ms per image")
+    np.save(args.output, disparities)
+    print(f"Saved disparities to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,12 @@
+import copy
 import datetime
+import functools
+import threading
 import torch
 
 import logging
 import os
+from queue import Queue
 from shutil import copyfile
 from subprocess import Popen, PIPE
 
@@ -26,6 +30,111 @@ from tensorboardX import SummaryWriter
 logger = logging.getLogger(__name__)
 
 
+def _main_process_only(method):
+    """Skip a method in all processes of a distributed run except rank 0"""
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self._rank == 0:
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+class CheckpointWriter:
+    """
+    Writes checkpoints on a background thread, such that the training does not wait for the
+    serialization and the storage. The tensors are copied to the cpu when a checkpoint is added,
+    so the training may change them afterwards. Every file is written to a temporary file first and
+    renamed when complete, i.e. an interruption never leaves a partially written checkpoint behind.
+    """
+
+    def __init__(self, max_pending: int = 2):
+        """
+        Args:
+            max_pending: maximum number of checkpoints that are copied but not yet written, adding
+                         another one waits for the oldest. 0 writes the checkpoints synchronously
+        """
+        self._max_pending = max_pending
+        self._error = None
+        if max_pending > 0:
+            self._pending = threading.Semaphore(max_pending)
+            self._queue = Queue()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def save(self, obj, path: str, links: List[str] = ()) -> None:
+        """
+        Save an object (e.g. a state dict) with torch.save
+        Args:
+            obj: Object to save, the tensors are copied immediately
+            path (str): Destination
+            links (list): Additional destinations, which become hard links to path (copies if the
+                file system does not support hard links)
+        """
+        self._raise_error()
+        if self._max_pending == 0:
+            self._write(obj, path, links)
+            return
+
+        self._pending.acquire()
+        self._queue.put((_cpu_copy(obj), path, links))
+
+    def flush(self) -> None:
+        """Wait until all checkpoints are written"""
+        if self._max_pending > 0:
+            self._queue.join()
+        self._raise_error()
+
+    def _run(self):
+        while True:
+            obj, path, links = self._queue.get()
+            try:
+                self._write(obj, path, links)
+            except Exception as e:
+                logger.error(f"Could not save checkpoint {path}: {e}")
+                self._error = e
+            finally:
+                self._pending.release()
+                self._queue.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    @staticmethod
+    def _write(obj, path, links):
+        tmp_path = f"{path}.tmp"
+        torch.save(obj, f=tmp_path)
+        os.replace(tmp_path, path)
+
+        for link in links:
+            tmp_link = f"{link}.tmp"
+            if os.path.exists(tmp_link):
+                os.remove(tmp_link)
+            try:
+                os.link(path, tmp_link)
+            except OSError:
+                copyfile(path, tmp_link)
+            os.replace(tmp_link, link)
+
+
+def _cpu_copy(obj):
+    """Copy of a (nested) state dict with all tensors copied to the cpu"""
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        # Shallow copy keeps the type and attributes, e.g. the _metadata of state dicts
+        result = copy.copy(obj)
+        for key, value in obj.items():
+            result[key] = _cpu_copy(value)
+        return result
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_cpu_copy(value) for value in obj)
+    return copy.deepcopy(obj)
+
+
 class SummaryTracker:
     """
     The summary tracker stores all results and data that can be collected during an
@@ -36,17 +145,22 @@ class SummaryTracker:
     - checkpoints: Model checkpoints
     - args.txt: File containing all commandline arguments with which the
     experiment has been started
+    In a distributed run, only the process with rank 0 writes results.
     """
 
-    def __init__(self, metric_names: List[str], args: Namespace, base_dir: str):
+    def __init__(
+        self, metric_names: List[str], args: Namespace, base_dir: str, rank: int = 0
+    ):
         """
         Initialize the Evaluator object.
         Args:
             metric_names: Names of different metrics
             args: Command line arguments
+            rank: Rank of this process in a distributed run
         """
 
         self._base_dir = base_dir
+        self._rank = rank
 
         self._metric_names = metric_names
         self._metric_epochs_train = {name: [] for name in metric_names}
@@ -62,10 +176,21 @@ class SummaryTracker:
         self._best_val_loss = float("inf")
         self._best_cpt_path = os.path.join(self._checkpoints_dir, "best-model.pth")
         self._last_cpt_path = os.path.join(self._checkpoints_dir, "last-model.pth")
-        self._create_dirs()
+        self._state_cpt_path = os.path.join(self._checkpoints_dir, "training-state.pth")
+        if self._rank == 0:
+            self._create_dirs()
 
         # Tensorboard
-        self._summary_writer = SummaryWriter(log_dir=self._tensorboard_dir)
+        self._summary_writer = None
+        if self._rank == 0:
+            self._summary_writer = SummaryWriter(log_dir=self._tensorboard_dir)
+
+        # Checkpoints are written in the background
+        self._checkpoint_writer = None
+        if self._rank == 0:
+            self._checkpoint_writer = CheckpointWriter(
+                max_pending=getattr(args, "pending_checkpoints", 0)
+            )
 
         self._args = args
 
@@ -154,6 +279,7 @@ class SummaryTracker:
             suffix="val",
         )
 
+    @_main_process_only
     def _save_args(self):
         """Save arguments"""
         if self._args is None:
@@ -171,6 +297,7 @@ class SummaryTracker:
             content = header + "\n".join(lines)
             f.write(content)
 
+    @_main_process_only
     def add_epoch_metric(
         self, epoch: int, train_metric: float, val_metric, metric_name: str
     ) -> None:
@@ -204,6 +331,19 @@ class SummaryTracker:
             )
         )
 
+    @_main_process_only
+    def add_scalar(self, epoch: int, value: float, tag: str) -> None:
+        """
+        Add a single scalar value for an epoch, e.g. a diagnostic value
+        Args:
+            epoch (int): Epoch index
+            value (float): Scalar value
+            tag (str): Tag as short description/identifier of the value
+        """
+        self._summary_writer.add_scalar(tag=tag, scalar_value=value, global_step=epoch)
+        logging.info(f"{f'[{epoch}/{self._max_epochs}]': <10} ({tag}): {value:10f}")
+
+    @_main_process_only
     def add_image(self, epoch: int, img: Union[Tensor, np.ndarray], tag: str):
         """
         Add an image to the evaluation results
@@ -216,6 +356,7 @@ class SummaryTracker:
             tag="image/" + tag, img_tensor=img, global_step=epoch
         )
 
+    @_main_process_only
     def add_disparity_map(self, epoch: int, disp: Tensor, input_img: Tensor, idx: int):
         """
         Add an image to the evaluation results
@@ -266,28 +407,56 @@ class SummaryTracker:
             # tensorboard and align images with disparity maps
             self.add_image(1, input_img.squeeze(), f"{tag}/input")
 
+    @_main_process_only
     def add_checkpoint(
         self, model: nn.Module, val_loss: float, multi_gpu=False
     ) -> None:
         """
         Add a new checkpoint. Store latest model weights in checkpoints/last-model.pth
         and best model based on the current validation metric in
-        checkpoints/best-model.pth.
+        checkpoints/best-model.pth (a hard link to the last model file when it is written).
         Args:
             model (nn.Module): PyTorch model
             val_loss (float): Latest validation loss
         """
         if multi_gpu:
-            torch.save(model.module.state_dict(), f=self._last_cpt_path)
-            if val_loss < self._best_val_loss:
-                self._best_val_loss = val_loss
-                torch.save(model.module.state_dict(), f=self._best_cpt_path)
-        else:
-            torch.save(model.state_dict(), f=self._last_cpt_path)
-            if val_loss < self._best_val_loss:
-                self._best_val_loss = val_loss
-                torch.save(model.state_dict(), f=self._best_cpt_path)
+            model = model.module
+
+        links = []
+        if val_loss < self._best_val_loss:
+            self._best_val_loss = val_loss
+            links.append(self._best_cpt_path)
+        self._checkpoint_writer.save(model.state_dict(), self._last_cpt_path, links)
 
+    @_main_process_only
+    def add_training_state(self, state: dict) -> None:
+        """
+        Store the full training state in checkpoints/training-state.pth (replaced atomically,
+        such that an interruption while saving keeps the previous state).
+        Args:
+            state (dict): Training state, see Experiment.training_state
+        """
+        self._checkpoint_writer.save(state, self._state_cpt_path)
+
+    def state_dict(self) -> dict:
+        """Metric history and best validation loss, to continue an interrupted run"""
+        return dict(
+            metric_epochs_train=self._metric_epochs_train,
+            metric_epochs_val=self._metrics_epochs_val,
+            best_val_loss=self._best_val_loss,
+        )
+
+    def load_state_dict(self, state: dict) -> None:
+        """
+        Restore the state of an interrupted run
+        Args:
+            state (dict): State returned by state_dict()
+        """
+        self._metric_epochs_train = state["metric_epochs_train"]
+        self._metrics_epochs_val = state["metric_epochs_val"]
+        self._best_val_loss = state["best_val_loss"]
+
+    @_main_process_only
     def save(self):
         """
         Save some results:
@@ -297,6 +466,9 @@ class SummaryTracker:
         - Plots
         """
 
+        # Wait for the checkpoints that are still written in the background
+        self._checkpoint_writer.flush()
+
         # Save all scalars to a json for future processing
         self._summary_writer.export_scalars_to_json(
             os.path.join(self._base_dir, "metric-results.json")
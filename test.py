@@ -11,6 +11,7 @@ import numpy as np
 from eval.eval_utils import Result, results_to_csv_str
 from utils import get_model, to_device, setup_logging
 from monolab.data_loader import prepare_dataloader
+from monolab.networks.fusion import fuse_model
 from eval.eval_eigensplit import EvaluateEigen
 from eval.eval_kitti_gt import EvaluateKittiGT
 from eval.eval_synthia import EvaluateSynthia
@@ -114,6 +115,47 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument(
         "--pin-memory", default=True, help="pin_memory argument to all dataloaders"
     )
+    parser.add_argument(
+        "--fast-aspp",
+        default=False,
+        action="store_true",
+        help="Project the ASPP branches without concatenating them (same weights and results)",
+    )
+    parser.add_argument(
+        "--concat-free-decoder",
+        default=False,
+        action="store_true",
+        help="Split the decoder conv weights instead of concatenating upconvs, skips and \
+                        disparities (same weights and results)",
+    )
+    parser.add_argument(
+        "--fuse-model",
+        default=False,
+        action="store_true",
+        help="Fold batchnorms into convolutions and use in-place activations for testing",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=None,
+        help="Directory for pre-decoded image caches. If set, all images are decoded and \
+                        resized once into a memory-mapped cache per filenames file.",
+        metavar="DIR",
+    )
+    parser.add_argument(
+        "--shard-dir",
+        default=None,
+        help="Directory with tar shards of the filenames files (created with \
+                        helper-scripts/gen_shards.py). If set, images are streamed from the shards.",
+        metavar="DIR",
+    )
+    parser.add_argument(
+        "--draft-decode",
+        default="none",
+        choices=["none", "strict", "width"],
+        help="Decode JPEGs at a reduced scale close to the input size before resizing. \
+                        strict: never below the input size, width: only the width is kept \
+                        at least at the input width (faster for KITTI, height gets upsampled)",
+    )
     parser.add_argument("--log-file", default="monolab.log", help="Log file")
     args = parser.parse_args()
     return args
@@ -152,6 +194,9 @@ def run_test(model: nn.Module, device, result_dir, args):
         num_workers=args.num_workers,
         dataset=dataset,
         pin_memory=args.pin_memory,
+        cache_dir=args.cache_dir,
+        shard_dir=args.shard_dir,
+        draft_decode=args.draft_decode,
     )
 
     logging.info("Using a testing data set with {} images".format(n_img))
@@ -160,6 +205,8 @@ def run_test(model: nn.Module, device, result_dir, args):
         torch.cuda.synchronize()
 
     model.eval()
+    if args.fuse_model:
+        model = fuse_model(model)
     disparities = np.zeros((n_img, input_height, input_width), dtype=np.float32)
     disparities_pp = np.zeros((n_img, input_height, input_width), dtype=np.float32)
     with torch.no_grad():
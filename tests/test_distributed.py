@@ -0,0 +1,41 @@
+from argparse import Namespace
+
+import pytest
+import torch
+from torch.nn.parallel import DistributedDataParallel
+
+from monolab.loss import MonodepthLoss
+from utils import get_model
+
+
+@pytest.fixture
+def process_group(tmp_path):
+    torch.distributed.init_process_group(
+        backend="gloo", init_method=f"file://{tmp_path}/store", rank=0, world_size=1
+    )
+    yield
+    torch.distributed.destroy_process_group()
+
+
+@pytest.mark.parametrize("name", ["resnet50_md", "deeplab"])
+def test_distributed_training_steps(name, process_group):
+    args = Namespace(
+        output_stride=16,
+        encoder_dilations=[1, 1, 1, 1],
+        atrous_rates=[1, 6, 12, 18],
+        disable_skip_connections=False,
+        disable_aspp_global_avg_pooling=False,
+    )
+    torch.manual_seed(0)
+    model = DistributedDataParallel(get_model(name, args=args))
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+    loss_function = MonodepthLoss(device="cpu")
+
+    # Every parameter has to receive a gradient in each step, otherwise the
+    # second step fails with "Expected to have finished reduction"
+    for _ in range(2):
+        left, right = torch.rand(2, 2, 3, 64, 128)
+        loss = loss_function(model(left), [left, right])[0]
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
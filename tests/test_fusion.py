@@ -0,0 +1,42 @@
+from argparse import Namespace
+
+import pytest
+import torch
+from torch import nn
+
+from monolab.networks.fusion import fuse_model
+from utils import get_model
+
+
+@pytest.mark.parametrize(
+    "name", ["deeplab", "resnet50_md", "resnet18_md", "dummy", "vgg_md", "aspp_net"]
+)
+def test_fused_model_has_identical_outputs(name):
+    args = Namespace(
+        output_stride=16,
+        encoder_dilations=[1, 1, 1, 1],
+        atrous_rates=[1, 6, 12, 18],
+        disable_skip_connections=False,
+        disable_aspp_global_avg_pooling=False,
+    )
+    torch.manual_seed(0)
+    model = get_model(name, args=args)
+
+    # Non-trivial batchnorm statistics
+    for m in model.modules():
+        if isinstance(m, nn.BatchNorm2d):
+            m.running_mean.uniform_(-0.1, 0.1)
+            m.running_var.uniform_(0.5, 2.0)
+            m.weight.data.uniform_(0.5, 1.5)
+            m.bias.data.uniform_(-0.1, 0.1)
+    model.eval()
+
+    fused = fuse_model(model)
+    x = torch.rand(2, 3, 128, 256)
+    with torch.no_grad():
+        outputs = model(x)
+        fused_outputs = fused(x)
+
+    assert not any(isinstance(m, nn.BatchNorm2d) for m in fused.modules())
+    for output, fused_output in zip(outputs, fused_outputs):
+        torch.testing.assert_close(fused_output, output, rtol=1e-5, atol=1e-5)
@@ -0,0 +1,172 @@
+import pytest
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+from monolab.data_loader.transforms import ScalePyramid
+from monolab.loss import MonodepthLoss
+
+
+def reference_ssim(x, y):
+    """ SSIM with one AvgPool2d per pooled term, as before the pooling was fused """
+    C1 = 0.01 ** 2
+    C2 = 0.03 ** 2
+
+    mu_x = nn.AvgPool2d(3, 1)(x)
+    mu_y = nn.AvgPool2d(3, 1)(y)
+    mu_x_mu_y = mu_x * mu_y
+    mu_x_sq = mu_x.pow(2)
+    mu_y_sq = mu_y.pow(2)
+
+    sigma_x = nn.AvgPool2d(3, 1)(x * x) - mu_x_sq
+    sigma_y = nn.AvgPool2d(3, 1)(y * y) - mu_y_sq
+    sigma_xy = nn.AvgPool2d(3, 1)(x * y) - mu_x_mu_y
+
+    SSIM_n = (2 * mu_x_mu_y + C1) * (2 * sigma_xy + C2)
+    SSIM_d = (mu_x_sq + mu_y_sq + C1) * (sigma_x + sigma_y + C2)
+    SSIM = SSIM_n / SSIM_d
+
+    return torch.clamp((1 - SSIM) / 2, 0, 1)
+
+
+def reference_apply_disparity(img, disp):
+    """ Warp with a sampling grid created per call, as before the grids were cached """
+    batch_size, _, height, width = img.size()
+    x_base = torch.linspace(0, 1, width).repeat(batch_size, height, 1)
+    y_base = torch.linspace(0, 1, height).repeat(batch_size, width, 1).transpose(1, 2)
+    flow_field = torch.stack((x_base + disp[:, 0], y_base), dim=3)
+    return F.grid_sample(img, 2 * flow_field - 1, mode="bilinear", padding_mode="zeros")
+
+
+def reference_loss(loss, input, target):
+    """ MonodepthLoss.forward with separate warps and terms for the left and right view,
+        as before both views were evaluated in one batch
+    """
+    n = len(input)
+    left, right = target
+    left_pyramid, right_pyramid = [left], [right]
+    for i in range(1, n):
+        size = [left.size(2) // 2 ** i, left.size(3) // 2 ** i]
+        left_pyramid.append(F.interpolate(left, size=size, mode="area"))
+        right_pyramid.append(F.interpolate(right, size=size, mode="area"))
+
+    disp_left = [d[:, 0:1] for d in input]
+    disp_right = [d[:, 1:2] for d in input]
+
+    left_est = [
+        reference_apply_disparity(right_pyramid[i], -disp_left[i]) for i in range(n)
+    ]
+    right_est = [
+        reference_apply_disparity(left_pyramid[i], disp_right[i]) for i in range(n)
+    ]
+    right_left_disp = [
+        reference_apply_disparity(disp_right[i], -disp_left[i]) for i in range(n)
+    ]
+    left_right_disp = [
+        reference_apply_disparity(disp_left[i], disp_right[i]) for i in range(n)
+    ]
+
+    lr_loss = sum(
+        torch.mean(torch.abs(right_left_disp[i] - disp_left[i]))
+        + torch.mean(torch.abs(left_right_disp[i] - disp_right[i]))
+        for i in range(n)
+    )
+
+    def smoothness_x(disp, img):
+        weights = torch.exp(
+            -torch.mean(
+                torch.abs(img[:, :, :, :-1] - img[:, :, :, 1:]), 1, keepdim=True
+            )
+        )
+        return (disp[:, :, :, :-1] - disp[:, :, :, 1:]) * weights
+
+    disp_gradient_loss = sum(
+        (
+            torch.mean(torch.abs(smoothness_x(disp_left[i], left_pyramid[i])))
+            + torch.mean(torch.abs(smoothness_x(disp_right[i], right_pyramid[i])))
+        )
+        / 2 ** i
+        for i in range(n)
+    )
+
+    def image_loss(est, img):
+        return loss.SSIM_w * torch.mean(reference_ssim(est, img)) + (
+            1 - loss.SSIM_w
+        ) * torch.mean(torch.abs(est - img))
+
+    image_loss = sum(
+        image_loss(left_est[i], left_pyramid[i])
+        + image_loss(right_est[i], right_pyramid[i])
+        for i in range(n)
+    )
+
+    total = image_loss + loss.disp_gradient_w * disp_gradient_loss + loss.lr_w * lr_loss
+    return total, image_loss, disp_gradient_loss, lr_loss
+
+
+def _loss_inputs(seed):
+    torch.manual_seed(seed)
+    left, right = torch.rand(2, 4, 3, 32, 64)
+    disps = [
+        (0.3 * torch.rand(4, 2, 32 // 2 ** i, 64 // 2 ** i)).requires_grad_()
+        for i in range(4)
+    ]
+    return disps, [left, right]
+
+
+def _pyramids(target):
+    """ Image pyramids as computed per sample in the data loader and collated """
+    scale_pyramid = ScalePyramid(num_scales=4)
+    return [
+        [torch.stack(levels) for levels in zip(*map(scale_pyramid.pyramid, images))]
+        for images in target
+    ]
+
+
+@pytest.mark.parametrize("precomputed_pyramids", [False, True])
+def test_loss_matches_reference(precomputed_pyramids):
+    loss = MonodepthLoss(device="cpu")
+    for seed in range(3):
+        disps, target = _loss_inputs(seed)
+        pyramids = _pyramids(target) if precomputed_pyramids else None
+
+        losses = loss(disps, target, pyramids=pyramids)
+        reference_losses = reference_loss(loss, disps, target)
+        for value, reference_value in zip(losses, reference_losses):
+            torch.testing.assert_close(value, reference_value, rtol=1e-5, atol=1e-6)
+
+        grads = torch.autograd.grad(losses[0], disps)
+        reference_grads = torch.autograd.grad(reference_losses[0], disps)
+        for grad, reference_grad in zip(grads, reference_grads):
+            torch.testing.assert_close(grad, reference_grad, rtol=1e-4, atol=1e-6)
+
+
+def _inputs(seed):
+    torch.manual_seed(seed)
+    x = torch.rand(4, 3, 32, 64, requires_grad=True)
+    # Similar images as in the reconstruction loss
+    y = (x.detach() + 0.1 * torch.randn_like(x)).clamp(0, 1).requires_grad_()
+    return x, y
+
+
+def test_ssim_matches_reference():
+    loss = MonodepthLoss(device="cpu")
+    for seed in range(3):
+        x, y = _inputs(seed)
+        torch.testing.assert_close(
+            loss.SSIM(x, y), reference_ssim(x, y), rtol=1e-5, atol=1e-6
+        )
+
+
+def test_ssim_gradients_match_reference():
+    loss = MonodepthLoss(device="cpu")
+    for seed in range(3):
+        x, y = _inputs(seed)
+        weights = torch.rand(4, 3, 30, 62)
+
+        grads = torch.autograd.grad((loss.SSIM(x, y) * weights).sum(), (x, y))
+        reference_grads = torch.autograd.grad(
+            (reference_ssim(x, y) * weights).sum(), (x, y)
+        )
+        for grad, reference_grad in zip(grads, reference_grads):
+            torch.testing.assert_close(grad, reference_grad, rtol=1e-4, atol=1e-6)
@@ -0,0 +1,53 @@
+from argparse import Namespace
+
+import pytest
+import torch
+
+from utils import get_model
+
+
+@pytest.mark.parametrize(
+    "name, option, disable_skip_connections, disable_aspp_global_avg_pooling",
+    [
+        ("deeplab", "fast_aspp", False, False),
+        ("deeplab", "fast_aspp", False, True),
+        ("aspp_net", "fast_aspp", False, False),
+        ("deeplab", "concat_free_decoder", False, False),
+        ("resnet50_md", "concat_free_decoder", False, False),
+        ("resnet18_md", "concat_free_decoder", False, False),
+        ("resnet18_md", "concat_free_decoder", True, False),
+        ("aspp_net", "concat_free_decoder", False, False),
+    ],
+)
+def test_model_option_has_identical_results(
+    name, option, disable_skip_connections, disable_aspp_global_avg_pooling
+):
+    args = Namespace(
+        output_stride=16,
+        encoder_dilations=[1, 1, 1, 1],
+        atrous_rates=[1, 6, 12, 18],
+        disable_skip_connections=disable_skip_connections,
+        disable_aspp_global_avg_pooling=disable_aspp_global_avg_pooling,
+    )
+    torch.manual_seed(0)
+    model = get_model(name, args=args)
+    optimized = get_model(name, args=Namespace(**vars(args), **{option: True}))
+    # Checkpoints of the regular model can be loaded as they are
+    optimized.load_state_dict(model.state_dict())
+
+    x = torch.rand(2, 3, 64, 128)
+    outputs = model(x)
+    optimized_outputs = optimized(x)
+    for output, optimized_output in zip(outputs, optimized_outputs):
+        torch.testing.assert_close(optimized_output, output, rtol=1e-5, atol=1e-5)
+
+    weights = [torch.rand_like(output) for output in outputs]
+    sum((o * w).sum() for o, w in zip(outputs, weights)).backward()
+    sum((o * w).sum() for o, w in zip(optimized_outputs, weights)).backward()
+    parameters = dict(optimized.named_parameters())
+    for param_name, param in model.named_parameters():
+        # Rounding differences grow with the gradient magnitude in the first layers
+        atol = 1e-5 * max(param.grad.abs().max().item(), 1)
+        torch.testing.assert_close(
+            parameters[param_name].grad, param.grad, rtol=1e-4, atol=atol
+        )
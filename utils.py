@@ -1,13 +1,20 @@
+import random
 import time
+import threading
 from datetime import datetime
+from queue import Queue, Full
 
 from typing import Union, List, Dict
-import collections
+import collections.abc
+import numpy as np
 import torch
 
+from monolab.networks.resnet import Resnet
 from monolab.networks.resnet_md import MonodepthResnet50, MonodepthResnet18
 from monolab.networks.vgg_md import VGGMonodepth
 from monolab.networks.deeplab import DeepLab
+from monolab.networks.deeplab.aspp import ASPP
+from monolab.networks.decoder import MonodepthDecoder, MonodepthDecoderSkipless
 from monolab.networks.deeplab.aspp_net import MonodepthASPPNet
 from monolab.networks.dummy_model import DummyModel, DummyModel2
 
@@ -21,31 +28,289 @@ from email.mime.multipart import MIMEMultipart
 from email.mime.base import MIMEBase
 from email import encoders
 
+logger = logging.getLogger(__name__)
+
 
 def to_device(
-    x: Union[torch.Tensor, List[torch.tensor], Dict[str, torch.Tensor]], device: str
+    x: Union[torch.Tensor, List[torch.tensor], Dict[str, torch.Tensor]],
+    device: str,
+    non_blocking=False,
 ):
     """ Move a tensor or a collection of tensors to a device
 
     Args:
         x: tensor, dict of tensors or list of tensors
         device: e.g. 'cuda' or 'cpu'
+        non_blocking: asynchronous copy (effective for pinned memory to cuda)
 
     Returns:
         same structure as input, but on device
     """
     if torch.is_tensor(x):
-        return x.to(device=device)
+        return x.to(device=device, non_blocking=non_blocking)
     elif isinstance(x, str):
         return x
-    elif isinstance(x, collections.Mapping):
-        return {k: to_device(sample, device=device) for k, sample in x.items()}
-    elif isinstance(x, collections.Sequence):
-        return [to_device(sample, device=device) for sample in x]
+    elif isinstance(x, collections.abc.Mapping):
+        return {
+            k: to_device(sample, device=device, non_blocking=non_blocking)
+            for k, sample in x.items()
+        }
+    elif isinstance(x, collections.abc.Sequence):
+        return [
+            to_device(sample, device=device, non_blocking=non_blocking) for sample in x
+        ]
+    else:
+        raise TypeError("Input must contain tensor, dict or list, found %s" % type(x))
+
+
+def split_batch(
+    x: Union[torch.Tensor, List[torch.tensor], Dict[str, torch.Tensor]], size: int
+):
+    """ Split a batch into chunks of at most size samples
+
+    Args:
+        x: tensor, dict of tensors or list of tensors, batched along the first dimension
+        size: number of samples per chunk
+
+    Returns:
+        list of chunks with the same structure as the input
+    """
+    if torch.is_tensor(x):
+        return list(torch.split(x, size))
+    elif isinstance(x, collections.abc.Mapping):
+        chunks = {k: split_batch(sample, size) for k, sample in x.items()}
+        n_chunks = len(next(iter(chunks.values())))
+        return [{k: v[i] for k, v in chunks.items()} for i in range(n_chunks)]
+    elif isinstance(x, collections.abc.Sequence) and not isinstance(x, str):
+        chunks = [split_batch(sample, size) for sample in x]
+        return [list(chunk) for chunk in zip(*chunks)]
     else:
         raise TypeError("Input must contain tensor, dict or list, found %s" % type(x))
 
 
+def _tensors(x):
+    """ Iterate all tensors in a tensor, dict of tensors or list of tensors """
+    if torch.is_tensor(x):
+        yield x
+    elif isinstance(x, collections.abc.Mapping):
+        for sample in x.values():
+            yield from _tensors(sample)
+    elif isinstance(x, collections.abc.Sequence) and not isinstance(x, str):
+        for sample in x:
+            yield from _tensors(sample)
+
+
+class DevicePrefetcher:
+    """ Wraps a data loader and moves the upcoming batches to the device while the current batch
+    is being processed. On cuda, the copies from pinned memory are issued non-blocking on a side
+    stream. On the cpu, a background thread fetches the next batches from the loader.
+    The wrapper can be used like the loader itself (len, attributes).
+    """
+
+    # Marks the end of the loader in the background thread's queue
+    _END = object()
+
+    def __init__(self, loader, device: str, num_prefetch: int = 2):
+        """
+        Args:
+            loader: data loader to wrap
+            device: e.g. 'cuda:0' or 'cpu'
+            num_prefetch: number of batches fetched in advance by the background thread (cpu)
+        """
+        self.loader = loader
+        self.device = device
+        self.num_prefetch = num_prefetch
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
+
+    def __iter__(self):
+        if "cuda" in str(self.device):
+            return self._iter_cuda()
+        return self._iter_thread()
+
+    def _iter_cuda(self):
+        stream = torch.cuda.Stream(device=self.device)
+        loader_iter = iter(self.loader)
+
+        def load():
+            try:
+                batch = next(loader_iter)
+            except StopIteration:
+                return None
+            with torch.cuda.stream(stream):
+                return to_device(batch, self.device, non_blocking=True)
+
+        next_batch = load()
+        while next_batch is not None:
+            current_stream = torch.cuda.current_stream(device=self.device)
+            current_stream.wait_stream(stream)
+            batch = next_batch
+            # Memory allocated on the side stream is now used on the current stream
+            for t in _tensors(batch):
+                t.record_stream(current_stream)
+
+            next_batch = load()
+            yield batch
+
+    def _iter_thread(self):
+        queue = Queue(maxsize=self.num_prefetch)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return True
+                except Full:
+                    continue
+            return False
+
+        def fetch():
+            try:
+                for batch in self.loader:
+                    if not put((to_device(batch, self.device), None)):
+                        return
+                put((self._END, None))
+            except Exception as e:
+                put((None, e))
+
+        thread = threading.Thread(target=fetch, daemon=True)
+        thread.start()
+        try:
+            while True:
+                batch, error = queue.get()
+                if error is not None:
+                    raise error
+                if batch is self._END:
+                    break
+                yield batch
+        finally:
+            # Also reached when the consumer stops early
+            stop.set()
+            thread.join()
+
+
+class InMemoryLoader:
+    """ Wraps a data loader with a fixed order (e.g. the validation loader) and keeps its batches in
+    memory, optionally on the device. The first complete pass over the loader fills the cache, all
+    further passes are served from it. If the batches exceed the memory budget, the cache is dropped
+    and the batches are streamed from the loader as before.
+    """
+
+    def __init__(self, loader, budget_mb: float, device: str = None):
+        """
+        Args:
+            loader: data loader to wrap, must return the same batches on every pass
+            budget_mb: maximum size of the cached batches in MiB
+            device: keep the cached batches on this device, None keeps them where the loader puts them
+        """
+        self.loader = loader
+        self.budget = budget_mb * 2 ** 20
+        self.device = device
+        self.batches = None
+        self.streaming = False
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
+
+    def __iter__(self):
+        if self.batches is not None:
+            return iter(self.batches)
+        if self.streaming:
+            return iter(self.loader)
+        return self._fill()
+
+    def _fill(self):
+        batches = []
+        nbytes = 0
+        for batch in self.loader:
+            if batches is not None:
+                if self.device is not None:
+                    batch = to_device(batch, self.device)
+                nbytes += sum(t.numel() * t.element_size() for t in _tensors(batch))
+                if nbytes > self.budget:
+                    logger.warning(
+                        f"Batches exceed the cache budget of {self.budget / 2 ** 20:g} MiB, "
+                        f"streaming them instead"
+                    )
+                    batches = None
+                    self.streaming = True
+                else:
+                    batches.append(batch)
+            yield batch
+
+        # Only a complete pass fills the cache
+        if batches is not None:
+            self.batches = batches
+            logger.info(
+                f"Cached {len(batches)} batches ({nbytes / 2 ** 20:.1f} MiB) in memory"
+            )
+
+
+class LossAccumulator:
+    """ Running sums of scalar losses that stay on the device. Adding a loss does not synchronize
+    with the device (unlike loss.item()), the sums are only copied to the host on flush(), e.g.
+    once per epoch or logging interval.
+    """
+
+    def __init__(self, names: List[str], device: str, world_size: int = 1):
+        """
+        Args:
+            names: names of the accumulated losses, in the order they are passed to add()
+            device: device of the losses
+            world_size: number of processes of a distributed run, the sums are all-reduced over
+                        them on flush() (which then has to be called by all processes)
+        """
+        self.names = names
+        self.device = device
+        self.world_size = world_size
+        self.sums = torch.zeros(len(names), dtype=torch.float64, device=device)
+        self.totals = [0.0] * len(names)
+        self.count = 0
+
+    def add(self, *losses: torch.Tensor):
+        """ Add one scalar tensor per loss name """
+        self.sums += torch.stack([loss.detach().to(torch.float64) for loss in losses])
+        self.count += 1
+
+    def flush(self) -> Dict[str, float]:
+        """ Move the device sums to the host (synchronizes with the device)
+
+        Returns:
+            total of every loss since the last reset (over all processes), by name
+        """
+        if self.world_size > 1:
+            torch.distributed.all_reduce(self.sums)
+        for i, value in enumerate(self.sums.tolist()):
+            self.totals[i] += value
+        self.sums.zero_()
+        return dict(zip(self.names, self.totals))
+
+    def means(self, n: int = None) -> Dict[str, float]:
+        """ Flush and average the losses
+
+        Args:
+            n: divisor per process, defaults to the number of add() calls
+
+        Returns:
+            mean of every loss (over all processes), by name
+        """
+        n = (n if n is not None else self.count) * self.world_size
+        return {name: total / max(n, 1) for name, total in self.flush().items()}
+
+    def reset(self):
+        self.sums.zero_()
+        self.totals = [0.0] * len(self.names)
+        self.count = 0
+
+
 def get_model(
     model: str, args, n_input_channels=3, pretrained=False
 ) -> torch.nn.Module:
@@ -94,9 +359,109 @@ def get_model(
         )
     else:
         raise NotImplementedError(f"Unknown model type: {model}")
+
+    # Gradient checkpointing in the resnet encoders (training only)
+    checkpoint_resblocks = getattr(args, "grad_checkpoint_resblocks", None)
+    if checkpoint_resblocks:
+        encoders = [m for m in out_model.modules() if isinstance(m, Resnet)]
+        if not encoders:
+            logger.warning(f"Model {model} has no resnet encoder to checkpoint")
+        for encoder in encoders:
+            encoder.set_checkpointing(checkpoint_resblocks)
+
+    # Concatenation-free projection in the ASPP heads (same weights)
+    if getattr(args, "fast_aspp", False):
+        for m in out_model.modules():
+            if isinstance(m, ASPP):
+                m.split_projection = True
+
+    # Split iconv weights instead of concatenating the decoder inputs (same weights)
+    if getattr(args, "concat_free_decoder", False):
+        for m in out_model.modules():
+            if isinstance(m, (MonodepthDecoder, MonodepthDecoderSkipless)):
+                m.concat_free = True
     return out_model
 
 
+def init_distributed(backend: str = "gloo"):
+    """ Join the process group of a distributed run started with torchrun, which sets the
+    environment variables RANK, WORLD_SIZE, LOCAL_RANK, MASTER_ADDR and MASTER_PORT
+
+    Args:
+        backend: "gloo" (cpu and cuda) or "nccl" (cuda only)
+
+    Returns:
+        rank and world size of this process
+    """
+    if "RANK" not in os.environ:
+        raise RuntimeError(
+            "Distributed training has to be launched with torchrun, e.g. "
+            "torchrun --nproc_per_node 4 main.py --distributed ..."
+        )
+    torch.distributed.init_process_group(backend=backend, init_method="env://")
+    return distributed_rank()
+
+
+def distributed_rank():
+    """ Rank and world size of this process, (0, 1) if it is not part of a process group """
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        return torch.distributed.get_rank(), torch.distributed.get_world_size()
+    return 0, 1
+
+
+def broadcast_object(obj, src: int = 0):
+    """ Send a picklable object from process src to all processes (no-op without process group)
+
+    Args:
+        obj: object, only used on process src
+        src: rank of the sending process
+
+    Returns:
+        the object of process src
+    """
+    if distributed_rank()[1] == 1:
+        return obj
+    objects = [obj]
+    torch.distributed.broadcast_object_list(objects, src=src)
+    return objects[0]
+
+
+def gather_object(obj) -> list:
+    """ Collect a picklable object from all processes (no-op without process group)
+
+    Args:
+        obj: object of this process
+
+    Returns:
+        list of the objects of all processes, by rank
+    """
+    world_size = distributed_rank()[1]
+    if world_size == 1:
+        return [obj]
+    objects = [None] * world_size
+    torch.distributed.all_gather_object(objects, obj)
+    return objects
+
+
+def rng_state() -> dict:
+    """ States of the python, numpy and torch (cpu and cuda) random number generators """
+    return dict(
+        python=random.getstate(),
+        numpy=np.random.get_state(),
+        torch=torch.get_rng_state(),
+        cuda=torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+    )
+
+
+def set_rng_state(state: dict):
+    """ Restore the random number generators from a state returned by rng_state() """
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if state["cuda"] and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
 def setup_logging(filename: str = "monolab.log", level: str = "INFO"):
     """
         Setup global loggers